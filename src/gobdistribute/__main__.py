@@ -1,27 +1,94 @@
+import argparse
+import sys
+import threading
+from contextlib import closing
+
 from gobcore.logging.logger import logger
 from gobcore.message_broker.config import WORKFLOW_EXCHANGE, DISTRIBUTE, DISTRIBUTE_QUEUE, DISTRIBUTE_RESULT_KEY
 from gobcore.message_broker.messagedriven_service import messagedriven_service
 from gobcore.message_broker.notifications import listen_to_notifications, get_notification
 from gobcore.workflow.start_workflow import start_workflow
 
-from gobdistribute.distribute import distribute
+from gobdistribute.config import PROFILE, SHARD_BY
+from gobdistribute.distribute import distribute, get_filesets
+from gobdistribute.history import RunHistory, report
+from gobdistribute.joblog import job_log
+from gobdistribute.profiling import profiled
+from gobdistribute.sharding import MessageBroker, declare_shard_queue, distribute_sharded, process_shard
+
+
+broker = MessageBroker()
+
+# Distributions are run one at a time. The distribute requests and the sub-jobs of sharded requests are handled in
+# separate threads, and the replica that gathers the results of a sharded request processes sub-jobs itself
+distribution_lock = threading.RLock()
 
 
 def handle_distribute_msg(msg):
     header = msg['header']
+    shard_by = header.get('shard_by', SHARD_BY)
 
-    distribute(catalogue=header['catalogue'], fileset=header.get('fileset'))
+    if shard_by and not header.get('fileset'):
+        # Each sub-job is profiled on its own
+        summary = _distribute_sharded(header, shard_by)
+    else:
+        with distribution_lock, _profiled(header):
+            distribute(catalogue=header['catalogue'], fileset=header.get('fileset'))
+        summary = {
+            "warnings": logger.get_warnings(),
+            "errors": logger.get_errors()
+        }
 
     return {
         "header": msg.get("header"),
-        "summary": {
-            "warnings": logger.get_warnings(),
-            "errors": logger.get_errors()
-        },
+        "summary": summary,
         "contents": None
     }
 
 
+def _profiled(header: dict):
+    """Profiles the enclosed distribution if enabled for the service or by the profile flag in header
+
+    :param header:
+    :return:
+    """
+    parts = [header['catalogue'], header.get('fileset') or 'all', header.get('destination'),
+             header.get('process_id', '')]
+    name = "_".join(['distribute'] + [part for part in parts if part is not None])
+    return profiled(name, enabled=PROFILE or bool(header.get('profile')))
+
+
+def _distribute_sharded(header: dict, shard_by: str) -> dict:
+    """Distributes the catalogue in sub-jobs, the sharded distribution is recorded as a run of the catalogue
+
+    The sub-jobs record their own runs. The run of the catalogue records the duration and the errors of all sub-jobs.
+
+    :param header:
+    :param shard_by:
+    :return: summary with the warnings and errors of the configuration and of all sub-jobs
+    """
+    with closing(RunHistory()) as history, history.recorded_run(header['catalogue']) as run:
+        with job_log() as summary:
+            filesets = get_filesets(header['catalogue'])
+
+        shards_summary = distribute_sharded(header, filesets, shard_by, broker, handle_shard_msg,
+                                            distribution_lock)
+        run.record_errors(len(summary['errors']) + len(shards_summary['errors']))
+
+    return {key: summary[key] + shards_summary[key] for key in summary}
+
+
+def handle_shard_msg(msg):
+    """
+    Distribute a sub-job of a distribute request, the result is sent to the replica that gathers the results
+
+    :param msg:
+    :return:
+    """
+    with distribution_lock, _profiled(msg['header']):
+        process_shard(msg, broker, distribute)
+
+
 def distribute_on_export_test(msg):
     """
     On a successfull export test, distribute the files
@@ -54,13 +121,38 @@ SERVICEDEFINITION = {
     'distribute': {
         'queue': lambda: listen_to_notifications("distribute", 'export_test'),
         'handler': distribute_on_export_test
+    },
+    'distribute_shard': {
+        'queue': lambda: declare_shard_queue(broker),
+        'handler': handle_shard_msg
     }
 }
 
 
+def main(argv):
+    """Starts the Distribute service, or runs the given command
+
+    :param argv: command line arguments
+    :return:
+    """
+    parser = argparse.ArgumentParser(prog="gobdistribute", description="GOB Distribute")
+    commands = parser.add_subparsers(dest="command")
+
+    history = commands.add_parser("history", help="Report distribution trends and regressions")
+    history.add_argument("catalogue", nargs="?", help="Report only runs of this catalogue")
+    history.add_argument("--runs", type=int, default=10, help="Number of runs to report (default 10)")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "history":
+        print(report(args.catalogue, args.runs))
+    else:
+        messagedriven_service(SERVICEDEFINITION, "Distribute")
+
+
 def init():
     if __name__ == "__main__":
-        messagedriven_service(SERVICEDEFINITION, "Distribute")
+        main(sys.argv[1:])
 
 
 init()
@@ -0,0 +1,162 @@
+"""Block map
+
+zsync control files of distributed files
+
+A zsync control file contains a rolling checksum and an MD4 checksum for each block of a file.
+Consumers that hold the previous version of a file, eg yesterday's {DATE} variant, fetch the new version with
+zsync (zsync -i <previous file> <url of the control file>) and download only the blocks that have changed.
+The control file refers to the file by its relative URL, so it is put next to the file on the destination.
+
+The format is that of zsyncmake 0.6.2. MD4 is taken from hashlib or pycryptodome when available,
+otherwise a (slow) pure Python implementation is used.
+
+"""
+import hashlib
+import math
+import os
+import struct
+from itertools import accumulate
+
+from gobdistribute.config import BLOCK_MAP_BLOCK_SIZE
+
+try:
+    from Crypto.Hash import MD4
+except ImportError:
+    MD4 = None
+
+BLOCK_MAP_EXTENSION = ".zsync"
+
+ZSYNC_VERSION = "0.6.2"
+
+_MASK = 0xffffffff
+
+
+def _rotl(x: int, n: int) -> int:
+    return ((x << n) | (x >> (32 - n))) & _MASK
+
+
+def _md4(data: bytes) -> bytes:
+    """Returns the MD4 digest of data (RFC 1320)
+
+    :param data:
+    :return:
+    """
+    length = len(data)
+    data = data + b'\x80' + b'\x00' * ((55 - length) % 64) + struct.pack('<Q', length * 8)
+    a, b, c, d = 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476
+
+    for offset in range(0, len(data), 64):
+        x = struct.unpack('<16I', data[offset:offset + 64])
+        aa, bb, cc, dd = a, b, c, d
+
+        for i in (0, 4, 8, 12):
+            a = _rotl((a + ((b & c) | (~b & d)) + x[i]) & _MASK, 3)
+            d = _rotl((d + ((a & b) | (~a & c)) + x[i + 1]) & _MASK, 7)
+            c = _rotl((c + ((d & a) | (~d & b)) + x[i + 2]) & _MASK, 11)
+            b = _rotl((b + ((c & d) | (~c & a)) + x[i + 3]) & _MASK, 19)
+        for i in (0, 1, 2, 3):
+            a = _rotl((a + ((b & c) | (b & d) | (c & d)) + x[i] + 0x5a827999) & _MASK, 3)
+            d = _rotl((d + ((a & b) | (a & c) | (b & c)) + x[i + 4] + 0x5a827999) & _MASK, 5)
+            c = _rotl((c + ((d & a) | (d & b) | (a & b)) + x[i + 8] + 0x5a827999) & _MASK, 9)
+            b = _rotl((b + ((c & d) | (c & a) | (d & a)) + x[i + 12] + 0x5a827999) & _MASK, 13)
+        for i in (0, 2, 1, 3):
+            a = _rotl((a + (b ^ c ^ d) + x[i] + 0x6ed9eba1) & _MASK, 3)
+            d = _rotl((d + (a ^ b ^ c) + x[i + 8] + 0x6ed9eba1) & _MASK, 9)
+            c = _rotl((c + (d ^ a ^ b) + x[i + 4] + 0x6ed9eba1) & _MASK, 11)
+            b = _rotl((b + (c ^ d ^ a) + x[i + 12] + 0x6ed9eba1) & _MASK, 15)
+
+        a, b, c, d = (a + aa) & _MASK, (b + bb) & _MASK, (c + cc) & _MASK, (d + dd) & _MASK
+
+    return struct.pack('<4I', a, b, c, d)
+
+
+def md4(data: bytes) -> bytes:
+    if 'md4' in hashlib.algorithms_available:
+        return hashlib.new('md4', data).digest()
+    if MD4:
+        return MD4.new(data).digest()
+    return _md4(data)
+
+
+def _rsum(block: bytes) -> bytes:
+    """Returns the rolling checksum of block, as 4 bytes in network order
+
+    a is the sum of the bytes, b the sum of the bytes weighted by their distance to the end of the block
+
+    :param block:
+    :return:
+    """
+    return struct.pack('>HH', sum(block) & 0xffff, sum(accumulate(block)) & 0xffff)
+
+
+def _block_size(length: int) -> int:
+    return BLOCK_MAP_BLOCK_SIZE or (2048 if length < 100_000_000 else 4096)
+
+
+def _hash_lengths(length: int, block_size: int) -> tuple:
+    """Returns the number of consecutive matching blocks and the checksum lengths, as computed by zsyncmake
+
+    :param length: file length
+    :param block_size:
+    :return: (seq_matches, rsum_len, checksum_len)
+    """
+    length = max(length, 1)
+    seq_matches = 2 if length > block_size else 1
+
+    rsum_len = math.ceil(((math.log(length) + math.log(block_size)) / math.log(2) - 8.6) / seq_matches / 8)
+    rsum_len = min(4, max(2, rsum_len))
+
+    checksum_len = math.ceil((20 + (math.log(length) + math.log(1 + length // block_size)) / math.log(2))
+                             / seq_matches / 8)
+    checksum_len2 = int((7.9 + (20 + math.log(1 + length // block_size) / math.log(2))) / 8)
+    return seq_matches, rsum_len, min(16, max(checksum_len, checksum_len2))
+
+
+def block_map(local_file: str, block_size: int = None) -> bytes:
+    """Returns the zsync control file for local_file
+
+    :param local_file:
+    :param block_size: number of bytes per block, chosen from the file size if not given
+    :return:
+    """
+    length = os.path.getsize(local_file)
+    block_size = block_size or _block_size(length)
+    seq_matches, rsum_len, checksum_len = _hash_lengths(length, block_size)
+
+    sha1 = hashlib.sha1()
+    checksums = []
+
+    with open(local_file, "rb") as f:
+        while block := f.read(block_size):
+            sha1.update(block)
+            # A short last block is padded with zeros
+            block = block.ljust(block_size, b'\0')
+            checksums.append(_rsum(block)[4 - rsum_len:] + md4(block)[:checksum_len])
+
+    filename = os.path.basename(local_file)
+    header = (f"zsync: {ZSYNC_VERSION}\n"
+              f"Filename: {filename}\n"
+              f"Blocksize: {block_size}\n"
+              f"Length: {length}\n"
+              f"Hash-Lengths: {seq_matches},{rsum_len},{checksum_len}\n"
+              f"URL: {filename}\n"
+              f"SHA-1: {sha1.hexdigest()}\n"
+              f"\n")
+    return header.encode() + b''.join(checksums)
+
+
+def write_block_map(local_file: str) -> str:
+    """Writes the zsync control file of local_file next to local_file and returns its path
+
+    An existing control file is reused, so the control file is computed once for all destinations
+
+    :param local_file:
+    :return:
+    """
+    block_map_file = f"{local_file}{BLOCK_MAP_EXTENSION}"
+
+    if not os.path.exists(block_map_file):
+        with open(block_map_file, "wb") as f:
+            f.write(block_map(local_file))
+
+    return block_map_file
@@ -4,9 +4,59 @@ Distribute configuration
 
 """
 import os
+import tempfile
 
 
 CONTAINER_BASE = os.getenv('CONTAINER_BASE', 'development')
 
 GOB_OBJECTSTORE = 'GOBObjectstore'
 EXPORT_API_HOST = os.getenv('EXPORT_API_HOST', 'http://localhost:8168')
+
+# Number of seconds a cached listing of a destination directory remains valid
+DESTINATION_LISTING_TTL = int(os.getenv('DESTINATION_LISTING_TTL', 300))
+
+# Directory in which the temporary workspaces for the filesets are created
+WORKSPACE_DIR = os.getenv('WORKSPACE_DIR', tempfile.gettempdir())
+# Maximum number of bytes reserved by all workspaces, 0 for no maximum (only free disk space)
+WORKSPACE_BUDGET = int(os.getenv('WORKSPACE_BUDGET', 0))
+# Maximum number of seconds a download is put on hold until workspace space is released
+WORKSPACE_ADMISSION_TIMEOUT = int(os.getenv('WORKSPACE_ADMISSION_TIMEOUT', 3600))
+# Maximum number of downloaded files of a fileset that wait to be distributed while the next files are downloaded
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 2))
+
+# Retries of transient errors, delays grow exponentially from RETRY_BACKOFF to RETRY_MAX_BACKOFF seconds
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 5))
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF', 0.5))
+RETRY_MAX_BACKOFF = float(os.getenv('RETRY_MAX_BACKOFF', 30))
+# A destination is put on hold after CIRCUIT_BREAKER_THRESHOLD consecutive failures,
+# for CIRCUIT_BREAKER_RESET_TIMEOUT seconds
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 3))
+CIRCUIT_BREAKER_RESET_TIMEOUT = int(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 300))
+
+# Block size (a power of 2) of the zsync control files that are distributed to destinations with delta enabled,
+# 0 to choose the block size from the file size, as zsyncmake does.
+# The control files let HTTP consumers download only changed blocks, they do not reduce the upload volume
+BLOCK_MAP_BLOCK_SIZE = int(os.getenv('BLOCK_MAP_BLOCK_SIZE', 0))
+
+# Database with the history of distribution runs, local to each replica.
+# SQLite locking is unreliable on network filesystems, do not place the database on a volume shared by replicas
+HISTORY_DB = os.getenv('HISTORY_DB', os.path.join(tempfile.gettempdir(), 'gobdistribute_history.sqlite'))
+# Number of seconds to wait for the lock on the database, when another process is writing to it
+HISTORY_DB_TIMEOUT = float(os.getenv('HISTORY_DB_TIMEOUT', 30))
+# A duration is reported as a regression when it exceeds the median of the previous runs by this factor
+HISTORY_REGRESSION_FACTOR = float(os.getenv('HISTORY_REGRESSION_FACTOR', 1.5))
+
+# Profile distribute runs, can also be enabled per message by a profile flag in the message header
+PROFILE = os.getenv('DISTRIBUTE_PROFILE', '').lower() in ('1', 'true', 'yes')
+# Directory in which the profiles are saved and the number of hotspots in the profile summary
+PROFILE_DIR = os.getenv('PROFILE_DIR', tempfile.gettempdir())
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 25))
+
+# Split distribute requests in sub-jobs per 'fileset' or per 'destination' (per fileset and destination),
+# can also be set per message by a shard_by value in the message header. Empty for no sub-jobs
+SHARD_BY = os.getenv('DISTRIBUTE_SHARD_BY', '')
+# Queue for the sub-jobs, that is consumed by all replicas
+SHARD_QUEUE = os.getenv('DISTRIBUTE_SHARD_QUEUE', 'gob.distribute.shard')
+# Number of seconds between polls for sub-job results, and the maximum number of seconds to wait for the next result
+SHARD_POLL_INTERVAL = float(os.getenv('DISTRIBUTE_SHARD_POLL_INTERVAL', 1))
+SHARD_TIMEOUT = int(os.getenv('DISTRIBUTE_SHARD_TIMEOUT', 2 * 60 * 60))
@@ -1,20 +1,38 @@
+import importlib
 import json
 import logging
+import mmap
 import os
 import re
-import tempfile
-from pathlib import Path
-from typing import List, Tuple, Iterator
+import time
+from contextlib import closing
+from typing import List, Tuple, Iterator, Iterable, TYPE_CHECKING
 
 from requests.exceptions import ConnectionError
 from gobconfig.datastore.config import get_datastore_config
-from gobcore.datastore.factory import Datastore, DatastoreFactory
-from gobcore.datastore.objectstore import ObjectDatastore, get_full_container_list, get_object
 from gobcore.exceptions import GOBException
-from gobcore.logging.logger import logger
 
-from gobdistribute.config import CONTAINER_BASE, EXPORT_API_HOST, GOB_OBJECTSTORE
-from gobdistribute.utils import json_loads, get_with_retries
+from gobdistribute.blockmap import BLOCK_MAP_EXTENSION, write_block_map
+from gobdistribute.config import CONTAINER_BASE, EXPORT_API_HOST, GOB_OBJECTSTORE, PIPELINE_QUEUE_SIZE
+from gobdistribute.history import Run, RunHistory
+from gobdistribute.joblog import logger
+from gobdistribute.listing import ListingCache
+from gobdistribute.pipeline import Pipeline
+from gobdistribute.resilience import get_circuit_breaker, is_not_found, is_transient, with_retries
+from gobdistribute.workspace import Workspace
+from gobdistribute.utils import json_loads, get_with_retries, lazy_import
+
+if TYPE_CHECKING:
+    from gobcore.datastore.factory import Datastore
+
+# The datastore backends are loaded when they are first used, to keep the startup of the service fast
+objectstore = lazy_import("gobcore.datastore.objectstore")
+
+# Datastore classes by datastore type, other types are created by the gobcore DatastoreFactory
+_DATASTORES = {
+    'objectstore': ("gobcore.datastore.objectstore", "ObjectDatastore"),
+    'sftp': ("gobcore.datastore.sftp", "SFTPDatastore"),
+}
 
 # Allow for variables in filenames. A variable will be converted into a regular expression
 # and vice versa for a generated proposal
@@ -27,16 +45,53 @@ WILDCARD = "*"
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
 
-def distribute(catalogue, fileset=None):
+def get_filesets(catalogue) -> dict:
+    """
+    Get the distribute configuration of the filesets in a given catalogue
+
+    :param catalogue:
+    :return:
+    """
+    datastore, _ = _get_datastore(GOB_OBJECTSTORE)
+    conn_info = {
+        "connection": datastore.connection,
+        "container": CONTAINER_BASE
+    }
+
+    filesets = _get_config(conn_info, catalogue, CONTAINER_BASE)
+    datastore.disconnect()
+    return filesets
+
+
+def _select_filesets(distribute_filesets: dict, fileset=None, destination=None) -> dict:
+    """Selects the fileset and the destination to distribute, if given
+
+    :param distribute_filesets: fileset configurations
+    :param fileset:
+    :param destination:
+    :return:
+    """
+    filesets = {fileset: distribute_filesets.get(fileset)} if fileset else distribute_filesets
+
+    if destination:
+        filesets = {name: {**config, 'destinations': [dst for dst in config.get('destinations', [])
+                                                      if dst['name'] == destination]}
+                    for name, config in filesets.items()}
+    return filesets
+
+
+def distribute(catalogue, fileset=None, destination=None):
     """
     Distribute export files for a given catalogue and optionally a collection
 
     :param catalogue: catalogue to distribute
     :param fileset: the fileset to distribute
+    :param destination: the destination to distribute to, requires fileset
     :return: None
     """
     distribute_info = f"Distribute catalogue {catalogue}"
     distribute_info += f" fileset {fileset}" if fileset else ""
+    distribute_info += f" to {destination}" if destination else ""
     logger.info(distribute_info)
 
     logger.info("Connect to Objectstore")
@@ -57,32 +112,215 @@ def distribute(catalogue, fileset=None):
     logger.info("Disconnect from Objectstore")
     datastore.disconnect()
 
-    filesets = {fileset: distribute_filesets.get(fileset)} if fileset else distribute_filesets
+    filesets = _select_filesets(distribute_filesets, fileset, destination)
+
+    with closing(RunHistory()) as history, history.recorded_run(catalogue, fileset, destination) as run:
+        deferred = {}
+        for fileset, config in filesets.items():
+            if destinations := _distribute_fileset(conn_info, fileset, config, catalogue, export_products, run):
+                deferred[fileset] = {**config, 'destinations': destinations}
+
+        _retry_deferred(conn_info, deferred, catalogue, export_products, run)
 
-    for fileset, config in filesets.items():
-        logger.info(f"Download fileset {fileset}")
-        temp_fileset_dir = os.path.join(tempfile.gettempdir(), fileset)
 
-        filenames = _get_filenames(conn_info, config, catalogue, export_products)
-        src_files = _download_sources(conn_info, temp_fileset_dir, filenames)
+def _retry_deferred(conn_info: dict, deferred: dict, catalogue: str, export_products: dict, run: Run):
+    """Retry the distribution of filesets to destinations that have failed earlier in the run
 
-        for destination in config.get('destinations', []):
-            logger.info(f"Connect to Destination {destination['name']}")
-            datastore, base_directory = _get_datastore(destination['name'])
+    Each deferred fileset is retried once, at the end of the run. Destinations that still fail, or that are still
+    on hold, are reported as errors and are not retried later on; they are brought up to date by the next
+    distribute request for the catalogue.
 
-            assert datastore.can_list_file() and datastore.can_delete_file(), \
-                "Datastore does not support file deletions"
+    :param conn_info: Objectstore connection
+    :param deferred: fileset configurations, limited to the destinations that have failed
+    :param catalogue:
+    :param export_products:
+    :param run: run history to record the statistics in
+    :return:
+    """
+    for fileset, config in deferred.items():
+        failed = config['destinations']
 
-            dst_dir = f"{base_directory}{destination['location']}"
+        if any(get_circuit_breaker(destination['name']).allow() for destination in failed):
+            logger.info(f"Retry deferred distribution of fileset {fileset}")
+            failed = _distribute_fileset(conn_info, fileset, config, catalogue, export_products, run, retry=True)
 
-            logger.info(f"Distribute new files to Destination: {destination['name']}")
-            logger.info(f"Distribute {len(src_files)} files to Location: {dst_dir}")
+        for destination in failed:
+            logger.error(f"Distribution of fileset {fileset} to {destination['name']} failed, "
+                         f"it will not be retried before the next distribution of {catalogue}")
 
-            _distribute_files(datastore, src_files, dst_dir)
-            logger.info(f"Done distributing files to {destination['name']}")
 
-            logger.info(f"Disconnect from Destination {destination['name']}")
-            datastore.disconnect()
+def _distribute_fileset(conn_info: dict, fileset: str, config: dict, catalogue: str, export_products: dict,
+                        run: Run, retry: bool = False) -> list:
+    """Distribute a fileset to all its destinations
+
+    The files are downloaded in a temporary workspace that is removed when the fileset has been distributed.
+
+    Returns the destinations for which the distribution has failed on a transient error, or that are on hold
+
+    Files are put while the next files are downloaded, so the distribution is not all-or-nothing. When a source
+    fails, or a destination fails on a non-transient error, the files before it have already been put and their
+    earlier versions deleted. The destinations are disconnected and the error is raised.
+
+    :param conn_info: Objectstore connection
+    :param fileset: name of the fileset
+    :param config: fileset configuration
+    :param catalogue:
+    :param export_products:
+    :param run: run history to record the statistics in
+    :param retry: whether the distribution is a retry to deferred destinations
+    :return:
+    """
+    logger.info(f"Distribute fileset {fileset}")
+
+    uploads = [_Upload(destination) for destination in config.get('destinations', [])]
+
+    try:
+        with Workspace(fileset) as workspace:
+            start = time.monotonic()
+            filenames = _get_filenames(conn_info, config, catalogue, export_products)
+            block_maps = any(upload.destination.get('delta') and not upload.result['error'] for upload in uploads)
+            downloads = _download_sources(conn_info, workspace, filenames, block_maps)
+            files, bytes = _distribute_downloads(downloads, uploads, workspace)
+            run.record_fileset(fileset, files, bytes, time.monotonic() - start, retry)
+    except Exception:
+        for upload in uploads:
+            upload.disconnect()
+        raise
+
+    failed = []
+    for upload in uploads:
+        result = upload.close()
+        run.record_destination(fileset, upload.name, result, upload.duration)
+
+        if result['error']:
+            failed.append(upload.destination)
+
+    return failed
+
+
+def _distribute_downloads(downloads: Iterable[Tuple[str, str, int]], uploads: List['_Upload'],
+                          workspace: Workspace) -> Tuple[int, int]:
+    """Puts each downloaded file on all destinations while the next files are being downloaded
+
+    The downloads run ahead of the uploads by at most PIPELINE_QUEUE_SIZE files.
+    A file is removed from the workspace as soon as it has been put on all destinations.
+
+    :param downloads: iterable of tuples (dst_path, local_file, size)
+    :param uploads: the uploads to the destinations of the fileset
+    :param workspace: workspace of the downloads
+    :return: the number of files and bytes downloaded
+    """
+    files, bytes = 0, 0
+
+    with Pipeline(downloads, PIPELINE_QUEUE_SIZE,
+                  discard=lambda download: workspace.release(download[1], download[2])) as pipeline:
+        for dst_path, local_file, size in pipeline:
+            try:
+                for upload in uploads:
+                    upload.put(dst_path, local_file)
+            finally:
+                workspace.release(local_file, size)
+                # The zsync control file, if any, has no reservation of its own
+                workspace.release(f"{local_file}{BLOCK_MAP_EXTENSION}", 0)
+
+            files, bytes = files + 1, bytes + size
+
+    logger.info(f"{files} source files distributed")
+    return files, bytes
+
+
+class _Upload:
+    """Distribution of the files of a fileset to a destination, file by file
+
+    The upload is guarded by the circuit breaker of the destination. The destination is connected when the first
+    file is put. After a transient error the remaining files are not put and the distribution is deferred.
+    """
+
+    def __init__(self, destination: dict):
+        """
+        :param destination: destination configuration
+        """
+        self.destination = destination
+        self.name = destination['name']
+        self.result = {'files': 0, 'bytes': 0, 'skipped': 0, 'error': None}
+        self.duration = 0
+        self.datastore = None
+        self.dst_dir = None
+        self._circuit_breaker = get_circuit_breaker(self.name)
+
+        if not self._circuit_breaker.allow():
+            logger.warning(f"Destination {self.name} is on hold, distribution is deferred")
+            self.result['error'] = "Destination on hold"
+
+    def put(self, dst_path: str, local_file: str):
+        """Puts local_file on dst_path, and its zsync control file if the destination has delta enabled
+
+        :param dst_path: path relative to the location of the destination
+        :param local_file:
+        :return:
+        """
+        if self.result['error']:
+            return
+
+        start = time.monotonic()
+        try:
+            self._put(dst_path, local_file)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            self._circuit_breaker.record_failure()
+            logger.warning(f"Distribution to {self.name} failed ({e}), distribution is deferred")
+            self.result['error'] = repr(e)
+        finally:
+            self.duration += time.monotonic() - start
+
+    def _put(self, dst_path: str, local_file: str):
+        if self.datastore is None:
+            self._connect()
+
+        result = _distribute_files(self.datastore, [(dst_path, local_file)], self.dst_dir, self.name)
+        for key, value in result.items():
+            self.result[key] += value
+
+        if self.destination.get('delta') and result['files']:
+            # The control file lets consumers fetch only the changed blocks with zsync. It has been written by the
+            # download, it is only written here for a file that has been downloaded without it.
+            # It is not counted as a distributed file
+            control_file = (f"{dst_path}{BLOCK_MAP_EXTENSION}", write_block_map(local_file))
+            _distribute_files(self.datastore, [control_file], self.dst_dir, self.name)
+
+    def _connect(self):
+        logger.info(f"Connect to Destination {self.name}")
+        datastore, base_directory = with_retries(_get_datastore, self.name)
+
+        assert datastore.can_list_file() and datastore.can_delete_file(), \
+            "Datastore does not support file deletions"
+
+        self.datastore = datastore
+        self.dst_dir = f"{base_directory}{self.destination['location']}"
+        logger.info(f"Distribute files to Destination {self.name}, Location: {self.dst_dir}")
+
+    def close(self) -> dict:
+        """Disconnects from the destination
+
+        Returns the number of files and bytes put and the number of files skipped.
+        The error is set if the destination is on hold or if the distribution has failed on a transient error
+
+        :return:
+        """
+        if not self.result['error']:
+            self._circuit_breaker.record_success()
+            logger.info(f"Done distributing {self.result['files']} files to {self.name}, "
+                        f"skipped {self.result['skipped']} files")
+
+        self.disconnect()
+        return self.result
+
+    def disconnect(self):
+        if self.datastore is not None:
+            logger.info(f"Disconnect from Destination {self.name}")
+            self.datastore.disconnect()
+            self.datastore = None
 
 
 def _get_export_products(catalogue: str):
@@ -101,20 +339,50 @@ def _get_export_products(catalogue: str):
     return data.get(catalogue)
 
 
-def _expand_filename_wildcard(conn_info: dict, filename: str):
-    """Returns all filenames from the given container that match filename, taking into consideration the wildcard
+def _listing_prefix(filename: str) -> str:
+    """Returns the literal leading part of filename, up to the first wildcard, variable or regular expression symbol.
+
+    Objectstore listings are sorted by name, so all candidate matches for filename are found in the contiguous block
+    of names that start with this prefix.
+
+    :param filename:
+    :return:
+    """
+    match = re.search(r"[*{.^$+?()\[\]\\|]", filename)
+    return filename[:match.start()] if match else filename
+
+
+def _sorted_listing(conn_info: dict, prefix: str) -> Iterator[dict]:
+    """Yields the items from the given container that start with prefix.
+
+    The listing is filtered on prefix by the Objectstore. As a guard, names that do not start with prefix are skipped
+    and reading the (sorted) container listing stops as soon as the names have passed prefix.
+
+    :param conn_info:
+    :param prefix:
+    :return:
+    """
+    for item in objectstore.get_full_container_list(conn_info['connection'], conn_info['container'], prefix=prefix):
+        if item['name'].startswith(prefix):
+            yield item
+        elif item['name'] > prefix:
+            return
+
+
+def _expand_filename_wildcard(conn_info: dict, filename: str) -> Iterator[str]:
+    """Yields all filenames from the given container that match filename, taking into consideration the wildcard
     symbol.
 
+    Matches are yielded while the listing is being read, so that downloads can start before the listing has finished.
+
     :param conn_info:
     :param filename:
     :return:
     """
-    result = []
-    match = filename.replace(WILDCARD, '.*')
-    for item in get_full_container_list(conn_info['connection'], conn_info['container']):
-        if re.match(match, item['name']) and item['content_type'] != 'application/directory':
-            result.append(item['name'])
-    return result
+    match = re.compile(filename.replace(WILDCARD, '.*'))
+    for item in _sorted_listing(conn_info, _listing_prefix(filename)):
+        if match.match(item['name']) and item['content_type'] != 'application/directory':
+            yield item['name']
 
 
 def _dst_path(source_file_path: str, base_dir: str):
@@ -124,21 +392,20 @@ def _dst_path(source_file_path: str, base_dir: str):
     return source_file_path.replace(base_dir, "")
 
 
-def _get_filenames(conn_info: dict, config: dict, catalogue: str, export_products: dict) -> List[Tuple[str, str]]:
+def _get_filenames(conn_info: dict, config: dict, catalogue: str, export_products: dict) -> Iterator[Tuple[str, str]]:
     """Determines filenames to download for sources in config.
 
     Source should have either 'file_name' or 'export' set. When source is 'file_name', this name is used. When source
     is 'export', the filenames to download are derived from the export products definition.
 
-    Returns a list op 2-tuples (dst_path, source_filename), where dst_path is the relative location on the destination
+    Yields 2-tuples (dst_path, source_filename), where dst_path is the relative location on the destination.
+    Filenames are yielded as soon as they are determined, so that the download of a file can start while the
+    remaining sources are still being resolved.
 
     :param config:
     :param catalogue:
     :return:
     """
-    # Download exports product definition
-    filenames = []
-
     logger.info("Determining files from source to distribute")
 
     for source in config.get('sources', []):
@@ -149,12 +416,12 @@ def _get_filenames(conn_info: dict, config: dict, catalogue: str, export_product
             source_path = base_dir + source['file_name']
 
             if WILDCARD in source['file_name']:
-                wildcard_files = _expand_filename_wildcard(conn_info, source_path)
-                filenames.extend([(_dst_path(filename, base_dir), filename) for filename in wildcard_files])
                 logger.info(f"Distribute files matching from source: {source_path}")
+                for filename in _expand_filename_wildcard(conn_info, source_path):
+                    yield _dst_path(filename, base_dir), filename
             else:
-                filenames.append((_dst_path(source_path, base_dir), source_path))
                 logger.info(f"Distribute file matching from source: {source_path}")
+                yield _dst_path(source_path, base_dir), source_path
 
         elif source.get('export'):
             collection_config = export_products.get(source['export']['collection'], {})
@@ -172,40 +439,54 @@ def _get_filenames(conn_info: dict, config: dict, catalogue: str, export_product
                 logger.info(f"Distribute files from source from export product set {source['export']['collection']} "
                             f"{product}")
 
-            filenames += [(item, item) for item in [f'{catalogue}/{item}' for item in products]]
-
-    return filenames
+            yield from [(item, item) for item in [f'{catalogue}/{item}' for item in products]]
 
 
-def _download_sources(conn_info, directory, filenames) -> List[Tuple[str, str]]:
+def _download_sources(conn_info, workspace: Workspace, filenames: Iterable[Tuple[str, str]],
+                      block_maps: bool = False) -> Iterator[Tuple[str, str, int]]:
     """
+    Disk space for each file is reserved in the workspace before the file is downloaded.
+    Downloads are retried on transient errors. Raises a GOBException when a source file does not exist.
+    The zsync control file of each file is written next to it if block_maps is set, so that it is computed while
+    the previous file is being uploaded.
+
+    Yields tuples (dst_path, local_file, size) as soon as a file has been downloaded. The size is the reserved
+    space, that is to be released when the file is no longer needed.
 
     :param conn_info:
-    :param directory:
-    :param filenames: list of tuples (dst_path, src_filename)
+    :param workspace: workspace to download the files to
+    :param filenames: iterable of tuples (dst_path, src_filename), downloaded as they are produced
+    :param block_maps: whether to write the zsync control files, for destinations with delta enabled
     :return:
     """
-    path = Path(directory)
-    path.mkdir(exist_ok=True)
-
-    src_files = []
-
     for dst_path, filename in filenames:
-        src_file_info, src_file = _get_file(conn_info, filename)
+        src_file_info = with_retries(_find_file, conn_info, filename)
+        if src_file_info is None:
+            raise GOBException(f"Source file {filename} not found")
 
-        temp_file = os.path.join(directory, dst_path)
-        path = Path(os.path.dirname(temp_file))
-        path.mkdir(exist_ok=True, parents=True)
+        size = src_file_info.get('bytes', 0)
+        workspace.reserve(size)
+        temp_file = workspace.filepath(dst_path)
 
-        with open(temp_file, "wb") as f:
-            for chunk in src_file:
-                f.write(chunk)
+        with_retries(_download_file, conn_info, src_file_info, temp_file)
+        workspace.written(size)
 
-        src_files.append((dst_path, temp_file))
+        if block_maps:
+            write_block_map(temp_file)
+        yield dst_path, temp_file, size
 
-    logger.info(f"{len(src_files)} source files downloaded")
 
-    return src_files
+def _download_file(conn_info: dict, obj_info: dict, local_file: str):
+    """Downloads the Objectstore object described by obj_info to local_file
+
+    :param conn_info: Objectstore connection
+    :param obj_info: Objectstore listing item
+    :param local_file:
+    :return:
+    """
+    with open(local_file, "wb") as f:
+        for chunk in objectstore.get_object(conn_info['connection'], obj_info, conn_info['container']):
+            f.write(chunk)
 
 
 def _get_datastore(destination_name: str):
@@ -216,14 +497,30 @@ def _get_datastore(destination_name: str):
     :return:
     """
     datastore_config = get_datastore_config(destination_name)
-    datastore = DatastoreFactory.get_datastore(datastore_config)
+    datastore = _create_datastore(datastore_config)
     datastore.connect()
 
     # Prepend main directory to file, except for ObjectDatastore, as this will use a container by default
-    base_directory = f"{CONTAINER_BASE}/" if not isinstance(datastore, ObjectDatastore) else ""
+    base_directory = f"{CONTAINER_BASE}/" if not isinstance(datastore, objectstore.ObjectDatastore) else ""
     return datastore, base_directory
 
 
+def _create_datastore(datastore_config: dict) -> 'Datastore':
+    """Returns a Datastore for datastore_config
+
+    Only the backend for the type of the datastore is imported. The gobcore DatastoreFactory imports all backends.
+
+    :param datastore_config:
+    :return:
+    """
+    if datastore_config.get('type') in _DATASTORES:
+        module, datastore_class = _DATASTORES[datastore_config['type']]
+        return getattr(importlib.import_module(module), datastore_class)(datastore_config)
+
+    from gobcore.datastore.factory import DatastoreFactory
+    return DatastoreFactory.get_datastore(datastore_config)
+
+
 def _apply_filename_replacements(filename: str):
     """Applies filename replacements to filename, if filename contains any patterns defined in _REPLACEMENTS.
 
@@ -237,72 +534,154 @@ def _apply_filename_replacements(filename: str):
     return filename
 
 
-def _distribute_files(datastore: Datastore, mapping: List[tuple], dst_dir: str):
+# Cached destination listings, existing files are looked up by their name after filename replacements
+listing_cache = ListingCache(normalize=_apply_filename_replacements)
+
+
+def _distribute_files(datastore: 'Datastore', mapping: List[tuple], dst_dir: str, destination_name: str):
     """
 
+    The existing files in dst_dir are taken from the listing cache, which is kept up to date with the files that are
+    put and deleted here. The cached listing is dropped whenever the result of a change is uncertain.
+
     :param datastore:
     :param mapping: list of tuples containing (destination_path, local_path) pairs
     :param dst_dir: base dir to distribute fils to, prepended to destination_path to get to the full path
-    :return:
+    :param destination_name: name of the destination, the datastore is connected to
+    :return: the number of files and bytes put and the number of files skipped
     """
-    distribute_files = {}
+    result = {'files': 0, 'bytes': 0, 'skipped': 0}
 
-    # Prepare distribution. Determine existing files to delete
     for dst_path, local_file in mapping:
         destination = f'{dst_dir}/{dst_path}'
-        fname_replaced = _apply_filename_replacements(destination)
-        distribute_files[fname_replaced] = {
-            'local_file': local_file,
-            'destination': destination,
-            'existing_files': [],
-        }
+        # Existing versions of the file, equal to destination after filename replacements (eg {DATE})
+        existing_files = listing_cache.find_files(datastore, destination_name, dst_dir, destination)
 
-    for f in datastore.list_files(dst_dir):
-        fname_replaced = _apply_filename_replacements(f)
-        if fname_replaced in distribute_files:
-            distribute_files[fname_replaced]['existing_files'].append(f)
+        try:
+            put = _distribute_file(datastore, local_file, destination, existing_files)
+        except Exception:
+            listing_cache.invalidate(destination_name, dst_dir)
+            raise
+
+        if put:
+            for f in existing_files:
+                listing_cache.remove_file(destination_name, dst_dir, f)
+            listing_cache.add_file(destination_name, dst_dir, destination)
+            result['files'] += 1
+            result['bytes'] += os.path.getsize(local_file)
+        else:
+            listing_cache.invalidate(destination_name, dst_dir)
+            result['skipped'] += 1
+
+    return result
 
-    for dist_file in distribute_files.values():
-        _distribute_file(datastore, dist_file['local_file'], dist_file['destination'], dist_file['existing_files'])
 
+def _distribute_file(datastore: 'Datastore', local_file: str, destination_filename: str, existing_files: List[str]):
+    """Deletes the existing files and puts local_file on destination_filename
 
-def _distribute_file(datastore: Datastore, local_file: str, destination_filename: str, existing_files: List[str]):
-    skip = False
+    Returns True if the file has been put, False if the distribution has been skipped because an existing file
+    could not be deleted. Transient errors are raised, so that the destination is deferred.
 
+    :param datastore:
+    :param local_file:
+    :param destination_filename:
+    :param existing_files:
+    :return:
+    """
     for f in existing_files:
         try:
-            datastore.delete_file(f)
-        except OSError:
-            logger.error(f"Could not delete file {f}. Skipping distribution of {destination_filename}")
-            skip = True
-            break
+            with_retries(datastore.delete_file, f)
+        except Exception as e:
+            if is_not_found(e):
+                # The cached listing is outdated, the file has already been deleted by others
+                logger.info(f"File {f} has already been deleted")
+            elif isinstance(e, OSError) and not is_transient(e):
+                logger.error(f"Could not delete file {f}. Skipping distribution of {destination_filename}")
+                return False
+            else:
+                raise
+
+    with_retries(_put_file, datastore, local_file, destination_filename)
+    return True
 
-    if not skip:
+
+def _put_file(datastore: 'Datastore', local_file: str, destination_filename: str):
+    """Puts local_file on destination_filename
+
+    SFTP destinations (a paramiko SFTPClient connection) are written from a read-only memory map of local_file.
+    All destinations then read the single copy of the file in the page cache, without a read buffer per upload.
+    Other destinations, and empty files that cannot be mapped, are put by the datastore.
+
+    :param datastore:
+    :param local_file:
+    :param destination_filename:
+    :return:
+    """
+    sftp = getattr(datastore, 'connection', None)
+    # The connection is matched by name, to prevent the import of paramiko
+    if type(sftp).__name__ != 'SFTPClient' or os.path.getsize(local_file) == 0:
         datastore.put_file(local_file, destination_filename)
+        return
 
+    _sftp_makedirs(sftp, os.path.dirname(destination_filename))
+    with open(local_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        sftp.putfo(view, destination_filename, file_size=len(view))
 
-def _get_file(conn_info, filename) -> tuple[dict[str, str], Iterator[bytes]]:
+
+def _sftp_makedirs(sftp, directory: str):
+    """Creates directory and its missing parents on the SFTP server
+
+    :param sftp: paramiko SFTPClient
+    :param directory:
+    :return:
     """
-    Get a file from Objectstore
+    if not directory or directory == '/':
+        return
+
+    try:
+        sftp.stat(directory)
+    except FileNotFoundError:
+        _sftp_makedirs(sftp, os.path.dirname(directory))
+        sftp.mkdir(directory)
+
+
+def _find_file(conn_info, filename) -> dict:
+    """
+    Find a file in Objectstore
     Applies filename replacements, to find files with variables (such as timestamps) in their names.
+    Only the part of the (sorted) container listing that can contain a match is read.
 
     :param conn_info: Objectstore connection
-    :param filename: name of the file to retrieve
-    :return:
+    :param filename: name of the file to find
+    :return: the listing item of the file, or None if no file has been found
     """
     filename = _apply_filename_replacements(filename)
 
     obj_info = None
-    obj = None
-    for item in get_full_container_list(conn_info['connection'], conn_info['container']):
+    for item in _sorted_listing(conn_info, _listing_prefix(filename)):
         item_name = _apply_filename_replacements(item['name'])
 
         if item_name == filename and (obj_info is None or item['last_modified'] > obj_info['last_modified']):
             # If multiple matches, match with the most recent item
             obj_info = dict(item)
-            obj = get_object(conn_info['connection'], item, conn_info['container'])
 
-    return obj_info, obj
+    return obj_info
+
+
+def _get_file(conn_info, filename) -> tuple[dict[str, str], Iterator[bytes]]:
+    """
+    Get a file from Objectstore
+
+    :param conn_info: Objectstore connection
+    :param filename: name of the file to retrieve
+    :return:
+    """
+    obj_info = _find_file(conn_info, filename)
+
+    if obj_info is None:
+        return None, None
+
+    return obj_info, objectstore.get_object(conn_info['connection'], obj_info, conn_info['container'])
 
 
 def _get_config(conn_info, catalogue: str, environment: str):
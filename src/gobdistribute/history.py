@@ -0,0 +1,304 @@
+"""History
+
+Run history of distributions
+
+The statistics of each run (per fileset and per destination) are stored in a SQLite database.
+The history is used to report throughput trends and to detect runs that are slower than usual.
+The history is not essential for the distribution itself: database errors are logged and do not fail a run.
+
+"""
+import sqlite3
+import statistics
+import time
+from contextlib import closing, contextmanager
+from typing import Iterator, List, Optional
+
+from gobdistribute.config import HISTORY_DB, HISTORY_DB_TIMEOUT, HISTORY_REGRESSION_FACTOR
+from gobdistribute.joblog import logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    catalogue TEXT NOT NULL,
+    fileset TEXT,
+    destination TEXT,
+    started_at REAL NOT NULL,
+    duration REAL,
+    errors INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS filesets (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    fileset TEXT NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    retry INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS destinations (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    fileset TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    skipped INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    error TEXT
+);
+"""
+
+# Columns that have been added to the schema, added to the tables of databases of earlier versions
+_ADDED_COLUMNS = [
+    ('runs', 'error', 'TEXT'),
+    ('runs', 'destination', 'TEXT'),
+    ('filesets', 'retry', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+
+class Run:
+
+    def __init__(self, history: 'RunHistory', catalogue: str, fileset: Optional[str], destination: Optional[str]):
+        self.history = history
+        self.started_at = time.time()
+        self.errors = 0
+
+        self.id = history.execute("INSERT INTO runs (catalogue, fileset, destination, started_at) VALUES (?, ?, ?, ?)",
+                                  (catalogue, fileset, destination, self.started_at))
+
+    def record_fileset(self, fileset: str, files: int, bytes: int, duration: float, retry: bool = False):
+        """Records the distribution of a fileset
+
+        A retry of a fileset to its deferred destinations is not added to the totals of the run
+
+        :param fileset:
+        :param files: number of files downloaded
+        :param bytes: number of bytes downloaded
+        :param duration: number of seconds to download the fileset and put it on its destinations,
+            the downloads and the uploads overlap
+        :param retry: whether the distribution is a retry of the fileset
+        :return:
+        """
+        self.history.execute(
+            "INSERT INTO filesets (run_id, fileset, files, bytes, duration, retry) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.id, fileset, files, bytes, duration, int(retry)))
+
+    def record_destination(self, fileset: str, destination: str, result: dict, duration: float):
+        """Records the distribution of a fileset to a destination
+
+        :param fileset:
+        :param destination:
+        :param result: dict with the number of files and bytes put, the number of files skipped and the error, if any
+        :param duration: number of seconds spent on putting files on the destination
+        :return:
+        """
+        self.errors += 1 if result['error'] else 0
+
+        self.history.execute(
+            "INSERT INTO destinations (run_id, fileset, destination, files, bytes, skipped, duration, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.id, fileset, destination, result['files'], result['bytes'], result['skipped'], duration,
+             result['error']))
+
+    def record_errors(self, errors: int):
+        """Records errors that have been reported elsewhere, eg by the sub-jobs of a sharded run
+
+        :param errors: number of errors
+        :return:
+        """
+        self.errors += errors
+
+    def finish(self, error: Optional[str] = None):
+        """Records the end of the run
+
+        :param error: the error that has ended the run, if any
+        :return:
+        """
+        self.errors += 1 if error else 0
+
+        self.history.execute("UPDATE runs SET duration = ?, errors = ?, error = ? WHERE id = ?",
+                             (time.time() - self.started_at, self.errors, error, self.id))
+
+
+class RunHistory:
+
+    def __init__(self, path: str = HISTORY_DB):
+        try:
+            self.connection = self._connect(path)
+        except sqlite3.Error as e:
+            logger.warning(f"Run history {path} is not available ({e}), the statistics are not saved")
+            self.connection = self._connect(":memory:")
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, timeout=HISTORY_DB_TIMEOUT)
+        try:
+            connection.executescript(_SCHEMA)
+            for table, column, definition in _ADDED_COLUMNS:
+                if column not in {info[1] for info in connection.execute(f"PRAGMA table_info({table})")}:
+                    # Database of an earlier version
+                    connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        except sqlite3.Error:
+            connection.close()
+            raise
+        return connection
+
+    def close(self):
+        self.connection.close()
+
+    def execute(self, query: str, parameters: tuple) -> Optional[int]:
+        """Executes query in a transaction, a database error is logged
+
+        :param query:
+        :param parameters:
+        :return: the id of the inserted row, if any
+        """
+        try:
+            with self.connection:
+                return self.connection.execute(query, parameters).lastrowid
+        except sqlite3.Error as e:
+            logger.warning(f"Run statistics could not be saved ({e})")
+
+    def start_run(self, catalogue: str, fileset: Optional[str] = None, destination: Optional[str] = None) -> Run:
+        return Run(self, catalogue, fileset, destination)
+
+    @contextmanager
+    def recorded_run(self, catalogue: str, fileset: Optional[str] = None,
+                     destination: Optional[str] = None) -> Iterator[Run]:
+        """Records the enclosed block as a run, an exception that is raised is recorded as the error of the run
+
+        :param catalogue:
+        :param fileset:
+        :param destination:
+        :return:
+        """
+        run = self.start_run(catalogue, fileset, destination)
+        error = None
+
+        try:
+            yield run
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            run.finish(error)
+
+    def runs(self, catalogue: Optional[str] = None, limit: int = 10) -> List[dict]:
+        """Returns the last limit finished runs, optionally for catalogue, most recent first
+
+        Each run contains the totals of the files and bytes downloaded, without retries, and the error that has
+        ended the run, if any
+
+        :param catalogue:
+        :param limit:
+        :return:
+        """
+        query = """
+            SELECT r.id, r.catalogue, r.fileset, r.destination, r.started_at, r.duration, r.errors, r.error,
+                   COALESCE(SUM(f.files), 0), COALESCE(SUM(f.bytes), 0)
+            FROM runs r
+            LEFT JOIN filesets f ON f.run_id = r.id AND f.retry = 0
+            WHERE r.duration IS NOT NULL AND (? IS NULL OR r.catalogue = ?)
+            GROUP BY r.id
+            ORDER BY r.started_at DESC, r.id DESC
+            LIMIT ?
+        """
+        columns = ['id', 'catalogue', 'fileset', 'destination', 'started_at', 'duration', 'errors', 'error', 'files',
+                   'bytes']
+        return [dict(zip(columns, row)) for row in self.connection.execute(query, (catalogue, catalogue, limit))]
+
+    def destination_durations(self, run_ids: List[int]) -> dict:
+        """Returns the distribution durations per (fileset, destination) for the given runs
+
+        :param run_ids:
+        :return: dict (fileset, destination) => dict run_id => duration
+        """
+        query = f"""
+            SELECT run_id, fileset, destination, duration
+            FROM destinations
+            WHERE error IS NULL AND run_id IN ({','.join('?' * len(run_ids))})
+        """
+        result = {}
+        for run_id, fileset, destination, duration in self.connection.execute(query, run_ids):
+            result.setdefault((fileset, destination), {})[run_id] = duration
+        return result
+
+
+def _throughput(run: dict) -> float:
+    return run['bytes'] / run['duration'] if run['duration'] else 0
+
+
+def _is_regression(latest: float, previous: List[float]) -> bool:
+    """Tells whether the latest duration is more than HISTORY_REGRESSION_FACTOR times the median previous duration
+
+    :param latest:
+    :param previous:
+    :return:
+    """
+    return bool(previous) and latest > HISTORY_REGRESSION_FACTOR * statistics.median(previous)
+
+
+def _scope(run: dict) -> tuple:
+    """Returns what has been distributed by run, only runs with the same scope are compared
+
+    :param run:
+    :return:
+    """
+    return run['catalogue'], run['fileset'], run['destination']
+
+
+def _format_runs(runs: List[dict]) -> List[str]:
+    lines = [f"{'started':19} {'catalogue':20} {'fileset':20} {'destination':20} {'files':>6} {'MB':>10} "
+             f"{'seconds':>9} {'MB/s':>8} {'errors':>6}"]
+    for run in runs:
+        lines.append(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started_at']))} "
+                     f"{run['catalogue']:20} {run['fileset'] or '':20} {run['destination'] or '':20} {run['files']:6} "
+                     f"{run['bytes'] / 1e6:10.1f} {run['duration']:9.1f} {_throughput(run) / 1e6:8.2f} "
+                     f"{run['errors']:6}" + (f" {run['error']}" if run['error'] else ""))
+    return lines
+
+
+def _regressions(history: RunHistory, latest: dict, previous: List[dict]) -> List[str]:
+    """Returns the regressions of the latest run compared to the previous runs, for the run as a whole
+    and for each fileset and destination
+
+    :param history:
+    :param latest:
+    :param previous: previous runs of the same catalogue, fileset and destination
+    :return:
+    """
+    regressions = []
+
+    if _is_regression(latest['duration'], [run['duration'] for run in previous]):
+        regressions.append(f"Run of {latest['catalogue']} took {latest['duration']:.1f} seconds")
+
+    durations = history.destination_durations([run['id'] for run in [latest] + previous])
+    for (fileset, destination), run_durations in sorted(durations.items()):
+        previous_durations = [run_durations[run['id']] for run in previous if run['id'] in run_durations]
+        if latest['id'] in run_durations and _is_regression(run_durations[latest['id']], previous_durations):
+            regressions.append(f"Distribution of {fileset} to {destination} took "
+                               f"{run_durations[latest['id']]:.1f} seconds")
+
+    return regressions
+
+
+def report(catalogue: Optional[str] = None, runs: int = 10, path: str = HISTORY_DB) -> str:
+    """Returns a report of the last runs and the regressions in the most recent run
+
+    :param catalogue: report only the runs of catalogue
+    :param runs: number of runs to report
+    :param path: path of the history database
+    :return:
+    """
+    with closing(RunHistory(path)) as history:
+        last_runs = history.runs(catalogue, runs)
+        if not last_runs:
+            return "No runs found"
+
+        latest = last_runs[0]
+        previous = [run for run in last_runs[1:]
+                    if _scope(run) == _scope(latest)]
+        regressions = _regressions(history, latest, previous)
+
+    return "\n".join(_format_runs(last_runs) + [""] + (
+        [f"Regression: {regression} (more than {HISTORY_REGRESSION_FACTOR}x the median)"
+         for regression in regressions] or ["No regressions"]))
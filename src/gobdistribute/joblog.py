@@ -0,0 +1,55 @@
+"""Job log
+
+Warnings and errors per distribution job
+
+The gobcore logger collects the warnings and errors of the process. A replica can handle a distribute request
+and a sub-job of a sharded request at the same time, so these lists may contain the messages of both.
+The job logger passes all messages on to the gobcore logger and also collects the warnings and errors in the job
+that is run in the current context. Threads that are started within a job, like the downloads of a Pipeline,
+run in a copy of the context of the job.
+
+"""
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from gobcore.logging.logger import logger as _logger
+
+_messages: contextvars.ContextVar = contextvars.ContextVar('job_messages', default=None)
+
+
+class JobLogger:
+    """The gobcore logger, that also collects the warnings and errors in the current job"""
+
+    def __getattr__(self, name):
+        return getattr(_logger, name)
+
+    def warning(self, msg, *args, **kwargs):
+        self._collect('warnings', msg)
+        _logger.warning(msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self._collect('errors', msg)
+        _logger.error(msg, *args, **kwargs)
+
+    @staticmethod
+    def _collect(level: str, msg):
+        if (messages := _messages.get()) is not None:
+            messages[level].append(msg)
+
+
+logger = JobLogger()
+
+
+@contextmanager
+def job_log() -> Iterator[Dict[str, List[str]]]:
+    """Runs the enclosed block as a job, collects the warnings and errors that are logged in it
+
+    :return: dict with the warnings and errors, filled while the block runs
+    """
+    messages = {'warnings': [], 'errors': []}
+    token = _messages.set(messages)
+    try:
+        yield messages
+    finally:
+        _messages.reset(token)
@@ -0,0 +1,92 @@
+"""Listing
+
+Cache of destination directory listings
+
+Listing a destination directory requires a full (recursive) walk of the remote directory tree.
+The cache keeps the listing for each destination and directory and is kept up to date by the
+files that are put and deleted by the distribution itself. Listings are refreshed after a TTL
+to pick up changes that have been made by others.
+The files are indexed by their normalized name, so that the existing versions of a file are
+found without a scan of the listing.
+
+"""
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Set, Tuple
+
+from gobdistribute.config import DESTINATION_LISTING_TTL
+from gobdistribute.resilience import with_retries
+
+
+class ListingCache:
+
+    def __init__(self, ttl: float = DESTINATION_LISTING_TTL, normalize: Callable[[str], str] = str):
+        """
+        :param ttl: number of seconds after which a cached listing is refreshed
+        :param normalize: maps a filename to the name under which it is looked up, eg with variables eliminated
+        """
+        self.ttl = ttl
+        self.normalize = normalize
+        # Per destination and directory the time of the listing and the files by normalized name
+        self._listings: Dict[Tuple[str, str], Tuple[float, Dict[str, Set[str]]]] = {}
+
+    def _index(self, datastore, destination: str, dst_dir: str) -> Dict[str, Set[str]]:
+        key = (destination, dst_dir)
+        cached = self._listings.get(key)
+
+        if cached is None or time.monotonic() - cached[0] >= self.ttl:
+            index = defaultdict(set)
+            for filename in with_retries(datastore.list_files, dst_dir):
+                index[self.normalize(filename)].add(filename)
+            cached = (time.monotonic(), index)
+            self._listings[key] = cached
+
+        return cached[1]
+
+    def find_files(self, datastore, destination: str, dst_dir: str, filename: str) -> List[str]:
+        """Returns the files in dst_dir on destination that have the same normalized name as filename, sorted
+
+        The datastore is only asked for a listing if no valid cached listing exists.
+
+        :param datastore: connected datastore for destination
+        :param destination: name of the destination
+        :param dst_dir:
+        :param filename:
+        :return:
+        """
+        return sorted(self._index(datastore, destination, dst_dir).get(self.normalize(filename), []))
+
+    def add_file(self, destination: str, dst_dir: str, filename: str):
+        """Registers a file that has been put in dst_dir on destination
+
+        :param destination:
+        :param dst_dir:
+        :param filename:
+        :return:
+        """
+        if (destination, dst_dir) in self._listings:
+            self._listings[(destination, dst_dir)][1][self.normalize(filename)].add(filename)
+
+    def remove_file(self, destination: str, dst_dir: str, filename: str):
+        """Registers a file that has been deleted from dst_dir on destination
+
+        :param destination:
+        :param dst_dir:
+        :param filename:
+        :return:
+        """
+        if (destination, dst_dir) in self._listings:
+            index = self._listings[(destination, dst_dir)][1]
+            name = self.normalize(filename)
+            index[name].discard(filename)
+            if not index[name]:
+                del index[name]
+
+    def invalidate(self, destination: str, dst_dir: str):
+        """Drops the cached listing for dst_dir on destination, the next request will list the datastore again
+
+        :param destination:
+        :param dst_dir:
+        :return:
+        """
+        self._listings.pop((destination, dst_dir), None)
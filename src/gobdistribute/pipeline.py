@@ -0,0 +1,103 @@
+"""Pipeline
+
+Producer/consumer pipeline with a bounded queue
+
+The items of the producer are produced in a background thread and passed to the consumer through a bounded queue.
+The producer is held when the queue is full, so it can never run more than the queue size ahead of the consumer.
+An exception in the producer is raised in the consumer, after the items that have been produced before.
+
+"""
+import contextvars
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+from gobdistribute.profiling import profile_thread
+
+# Number of seconds between checks whether the pipeline has been closed
+_POLL_INTERVAL = 0.1
+
+
+class _Failure:
+
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+_END = object()
+
+
+class Pipeline:
+
+    def __init__(self, items: Iterable, maxsize: int, discard: Optional[Callable] = None):
+        """
+        :param items: iterable that produces the items, iterated in a background thread
+        :param maxsize: maximum number of items that are produced but not yet consumed
+        :param discard: called for each produced item that is not consumed because the pipeline has been closed
+        """
+        self._queue = queue.Queue(maxsize)
+        self._discard = discard
+        self._closed = threading.Event()
+        # The producer runs in a copy of the context, eg of the job log of the distribution
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._produce, items),
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self) -> Iterator:
+        while (item := self._queue.get()) is not _END:
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+
+    def close(self):
+        """Stops the producer and discards the items that have not been consumed
+
+        :return:
+        """
+        self._closed.set()
+        while self._thread.is_alive():
+            self._drain()
+            self._thread.join(_POLL_INTERVAL)
+        self._drain()
+
+    def _produce(self, items: Iterable):
+        # Any failure, including one of the profiler, is passed to the consumer, that would otherwise wait forever
+        try:
+            with profile_thread():
+                for item in items:
+                    if not self._put(item):
+                        return
+        except Exception as e:
+            self._put(_Failure(e))
+        else:
+            self._put(_END)
+
+    def _put(self, item) -> bool:
+        """Puts item on the queue, waits for room while the pipeline is open
+
+        :param item:
+        :return: False if the pipeline has been closed
+        """
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _drain(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+            if self._discard and item is not _END and not isinstance(item, _Failure):
+                self._discard(item)
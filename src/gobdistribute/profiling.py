@@ -0,0 +1,129 @@
+"""Profiling
+
+Opt-in profiling of distribute runs
+
+Profiling is enabled by the DISTRIBUTE_PROFILE environment variable or by a profile flag in the message header.
+A sampling profiler (pyinstrument) is used when it is installed, otherwise cProfile.
+The profile and a summary of the top hotspots are saved in PROFILE_DIR, the summary is also written to the job log.
+
+Profilers only profile the thread they have been started in. Background threads that run within the profiled
+block in a copy of its context, like the downloads of a Pipeline, are profiled by cProfile when they run within
+profile_thread. With cProfile their profiles are merged into the profile of the block, with pyinstrument they are
+saved in a separate profile.
+
+"""
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import re
+from contextlib import contextmanager
+from typing import List
+
+from gobcore.logging.logger import logger
+
+from gobdistribute.config import PROFILE_DIR, PROFILE_TOP
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
+
+
+# Profiles of the background threads that have run within the profiled block of the current context, None if not
+# profiling. Background threads that run in a copy of the context, like the producer of a Pipeline, add to it
+_thread_profiles: contextvars.ContextVar = contextvars.ContextVar('thread_profiles', default=None)
+
+
+def _save_cprofiles(profiles: List[cProfile.Profile], path: str) -> str:
+    """Saves the merged profiles in path
+
+    :return: the top hotspots, by cumulative time
+    """
+    summary = io.StringIO()
+    stats = pstats.Stats(*profiles, stream=summary)
+    stats.dump_stats(path)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+    return summary.getvalue()
+
+
+def _save_cprofile(profiler: cProfile.Profile, path: str, thread_profiles: List[cProfile.Profile]) -> str:
+    """Saves the profile, merged with the thread profiles, in path.prof and the top hotspots in path.txt
+
+    :return: the hotspot summary
+    """
+    return _save_cprofiles([profiler] + thread_profiles, f"{path}.prof")
+
+
+def _save_sampling_profile(profiler, path: str, thread_profiles: List[cProfile.Profile]) -> str:
+    """Saves the profile in path.html, the thread profiles in path.threads.prof and the call tree in path.txt
+
+    :return: the hotspot summary
+    """
+    with open(f"{path}.html", "w") as f:
+        f.write(profiler.output_html())
+
+    summary = profiler.output_text()
+    if thread_profiles:
+        summary += "\nBackground threads\n" + _save_cprofiles(thread_profiles, f"{path}.threads.prof")
+    return summary
+
+
+@contextmanager
+def profile_thread():
+    """Profiles the enclosed block of a background thread as part of the current profiled block, if any
+
+    :return:
+    """
+    profiles = _thread_profiles.get()
+    if profiles is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiles.append(profiler)
+
+
+@contextmanager
+def profiled(name: str, enabled: bool):
+    """Profiles the enclosed block if enabled
+
+    :param name: name of the profile, used for the filenames
+    :param enabled:
+    :return:
+    """
+    if not enabled:
+        yield
+        return
+
+    path = os.path.join(PROFILE_DIR, re.sub(r"[^\w.-]", "_", name))
+
+    if SamplingProfiler:
+        profiler = SamplingProfiler()
+        start, stop, save = profiler.start, profiler.stop, _save_sampling_profile
+    else:
+        profiler = cProfile.Profile()
+        start, stop, save = profiler.enable, profiler.disable, _save_cprofile
+
+    thread_profiles = []
+    token = _thread_profiles.set(thread_profiles)
+
+    start()
+    try:
+        yield
+    finally:
+        stop()
+        _thread_profiles.reset(token)
+
+        summary = save(profiler, path, thread_profiles)
+        with open(f"{path}.txt", "w") as f:
+            f.write(summary)
+
+        logger.info(f"Profile saved in {path}")
+        logger.info(summary)
@@ -0,0 +1,123 @@
+"""Resilience
+
+Retries for transient errors and circuit breakers for destinations
+
+Transient errors (connection problems, HTTP 5xx responses from the Objectstore, SSH errors) are retried
+with an exponential backoff and full jitter. A destination that keeps failing is put on hold by its
+circuit breaker, so that filesets do not wait for timeouts against a destination that is down.
+
+"""
+import random
+import time
+from typing import Callable, Dict
+
+from gobdistribute.config import RETRY_ATTEMPTS, RETRY_BACKOFF, RETRY_MAX_BACKOFF, \
+    CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT
+from gobdistribute.joblog import logger
+
+# HTTP status codes (eg swiftclient ClientException.http_status) that indicate a transient error
+TRANSIENT_HTTP_STATUS = {408, 429, 500, 502, 503, 504}
+
+# OS errors that will not be solved by trying again
+_PERMANENT_OS_ERRORS = (FileNotFoundError, FileExistsError, PermissionError, IsADirectoryError, NotADirectoryError)
+
+# Exceptions of the datastore backends are matched by name, to prevent the import of the backend libraries.
+# Rejected credentials, host keys and algorithms are SSHExceptions that will not be solved by trying again
+_TRANSIENT_EXCEPTION_NAMES = {'SSHException'}
+_PERMANENT_EXCEPTION_NAMES = {'AuthenticationException', 'BadHostKeyException', 'IncompatiblePeer'}
+
+
+def is_transient(error: Exception) -> bool:
+    """Tells whether error is a transient error, that may not occur when trying again
+
+    :param error:
+    :return:
+    """
+    if isinstance(error, _PERMANENT_OS_ERRORS):
+        return False
+    if isinstance(error, OSError) or getattr(error, 'http_status', None) in TRANSIENT_HTTP_STATUS:
+        return True
+    names = {cls.__name__ for cls in type(error).__mro__}
+    return not names & _PERMANENT_EXCEPTION_NAMES and bool(names & _TRANSIENT_EXCEPTION_NAMES)
+
+
+def is_not_found(error: Exception) -> bool:
+    """Tells whether error reports a file or object that does not exist
+
+    :param error:
+    :return:
+    """
+    return isinstance(error, FileNotFoundError) or getattr(error, 'http_status', None) == 404
+
+
+def with_retries(func: Callable, *args, attempts: int = RETRY_ATTEMPTS, **kwargs):
+    """Calls func with args and kwargs, retries the call on transient errors
+
+    The delay before each retry is drawn at random between 0 and an exponentially growing maximum.
+
+    :param func:
+    :param attempts: maximum number of calls
+    :return: the result of func
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts or not is_transient(e):
+                raise
+
+            delay = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** (attempt - 1)))
+            logger.info(f"{getattr(func, '__name__', func)} failed ({e}), retry {attempt} in {delay:.1f} seconds")
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+
+    def __init__(self, name: str, threshold: int = CIRCUIT_BREAKER_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_BREAKER_RESET_TIMEOUT):
+        """
+        :param name: name of the destination
+        :param threshold: number of consecutive failures after which the circuit is opened
+        :param reset_timeout: number of seconds after which an open circuit allows a new attempt
+        """
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        """Tells whether an attempt is allowed
+
+        Attempts are allowed if the circuit is closed, or if it has been open for at least reset_timeout seconds
+
+        :return:
+        """
+        return self.opened_at is None or time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.warning(f"Destination {self.name} failed {self.failures} times, put on hold")
+            self.opened_at = time.monotonic()
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Returns the circuit breaker for destination name
+
+    Circuit breakers live as long as the process, so their state is kept between messages
+
+    :param name:
+    :return:
+    """
+    if name not in _circuit_breakers:
+        _circuit_breakers[name] = CircuitBreaker(name)
+    return _circuit_breakers[name]
@@ -0,0 +1,257 @@
+"""Sharding
+
+Distribution of a catalogue in sub-jobs, shared by the service replicas
+
+A distribute request can be split into sub-jobs per fileset or per fileset and destination.
+The sub-jobs are published to the shard queue, that is consumed by all replicas. Each sub-job
+sends its result to the reply queue of the job. The replica that has split the job gathers the
+results in a single report. While waiting it works on pending sub-jobs itself, so that a job is
+completed even when there are no other replicas. These sub-jobs are acknowledged when they have been
+processed, so a sub-job of a replica that stops is taken over by another replica.
+
+"""
+import copy
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from gobdistribute.config import SHARD_QUEUE, SHARD_POLL_INTERVAL, SHARD_TIMEOUT
+from gobdistribute.joblog import job_log, logger
+
+
+class MessageBroker:
+    """Queues on the message broker
+
+    Messages are routed directly to a queue by the default exchange.
+    Each thread keeps its own connection. Heartbeats are disabled on the connection, because no events are
+    processed while a sub-job is being processed. A connection that is lost is detected by the broker through TCP.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _channel(self):
+        channel = getattr(self._local, 'channel', None)
+
+        if channel is None or channel.is_closed:
+            import pika
+            from gobcore.message_broker.config import CONNECTION_PARAMS
+
+            parameters = copy.copy(CONNECTION_PARAMS)
+            parameters.heartbeat = 0
+            channel = self._local.channel = pika.BlockingConnection(parameters).channel()
+
+        return channel
+
+    def declare(self, queue: str):
+        self._channel().queue_declare(queue=queue, durable=True)
+
+    def delete(self, queue: str):
+        self._channel().queue_delete(queue=queue)
+
+    def publish(self, queue: str, msg: dict):
+        import pika
+
+        self._channel().basic_publish(exchange='', routing_key=queue, body=json.dumps(msg),
+                                      properties=pika.BasicProperties(delivery_mode=2))
+
+    def get(self, queue: str) -> Optional[dict]:
+        method, _, body = self._channel().basic_get(queue=queue, auto_ack=True)
+        return json.loads(body) if method else None
+
+    @contextmanager
+    def receive(self, queue: str) -> Iterator[Optional[dict]]:
+        """Receives the next message from queue, None if queue is empty
+
+        The message is acknowledged when the enclosed block has completed. It is returned to the queue when the
+        block raises, or when the connection is lost before, eg because the replica has stopped.
+
+        :param queue:
+        :return:
+        """
+        channel = self._channel()
+        method, _, body = channel.basic_get(queue=queue, auto_ack=False)
+
+        if not method:
+            yield None
+            return
+
+        try:
+            yield json.loads(body)
+        except BaseException:
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            raise
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+class LocalBroker:
+    """In-process stand-in for the MessageBroker, eg for tests"""
+
+    def __init__(self):
+        self.queues = defaultdict(deque)
+
+    def declare(self, queue: str):
+        self.queues.setdefault(queue, deque())
+
+    def delete(self, queue: str):
+        self.queues.pop(queue, None)
+
+    def publish(self, queue: str, msg: dict):
+        self.queues[queue].append(json.dumps(msg))
+
+    def get(self, queue: str) -> Optional[dict]:
+        return json.loads(self.queues[queue].popleft()) if self.queues[queue] else None
+
+    @contextmanager
+    def receive(self, queue: str) -> Iterator[Optional[dict]]:
+        body = self.queues[queue].popleft() if self.queues[queue] else None
+
+        try:
+            yield json.loads(body) if body else None
+        except BaseException:
+            self.queues[queue].appendleft(body)
+            raise
+
+
+def declare_shard_queue(broker=None) -> str:
+    """Declares the shard queue and returns its name
+
+    :param broker:
+    :return:
+    """
+    (broker or MessageBroker()).declare(SHARD_QUEUE)
+    return SHARD_QUEUE
+
+
+def split(filesets: dict, shard_by: str) -> List[Tuple[str, Optional[str]]]:
+    """Splits filesets in (fileset, destination) parts
+
+    :param filesets: fileset configurations
+    :param shard_by: 'fileset' or 'destination'
+    :return: list of (fileset, destination) tuples, destination is None when splitting per fileset
+    """
+    if shard_by == 'destination':
+        return [(fileset, destination['name'])
+                for fileset, config in filesets.items() for destination in config.get('destinations', [])]
+    return [(fileset, None) for fileset in filesets]
+
+
+def distribute_sharded(header: dict, filesets: dict, shard_by: str, broker, process: Callable,
+                       lock: Optional[threading.RLock] = None) -> dict:
+    """Distributes filesets in sub-jobs and returns the summary of all sub-jobs
+
+    :param header: header of the distribute request
+    :param filesets: fileset configurations
+    :param shard_by: 'fileset' or 'destination'
+    :param broker: MessageBroker or LocalBroker
+    :param process: processes a sub-job message, used to work on pending sub-jobs while waiting
+    :param lock: held by the distributions of the process, pending sub-jobs are only taken when it is free
+    :return: summary with warnings and errors
+    """
+    job_id = uuid.uuid4().hex
+    reply_to = f"{SHARD_QUEUE}.{job_id}"
+    parts = split(filesets, shard_by)
+
+    logger.info(f"Distribute catalogue {header['catalogue']} in {len(parts)} sub-jobs")
+
+    broker.declare(reply_to)
+    try:
+        for index, (fileset, destination) in enumerate(parts):
+            broker.publish(SHARD_QUEUE, {
+                'header': {
+                    **header,
+                    'fileset': fileset,
+                    'destination': destination,
+                    'shard': {'job_id': job_id, 'index': index, 'count': len(parts), 'reply_to': reply_to},
+                }
+            })
+
+        results = _gather(broker, reply_to, len(parts), process, lock or threading.RLock())
+    finally:
+        broker.delete(reply_to)
+
+    return _aggregate(parts, results)
+
+
+def _gather(broker, reply_to: str, count: int, process: Callable, lock: threading.RLock) -> dict:
+    """Gathers the results of count sub-jobs from reply_to, works on pending sub-jobs in the meantime
+
+    Gives up when no progress has been made for SHARD_TIMEOUT seconds
+
+    :return: dict index => summary
+    """
+    results = {}
+    deadline = time.monotonic() + SHARD_TIMEOUT
+
+    while len(results) < count and time.monotonic() < deadline:
+        if result := broker.get(reply_to):
+            results[result['header']['index']] = result['summary']
+        elif not _process_pending(broker, process, lock):
+            time.sleep(SHARD_POLL_INTERVAL)
+            continue
+
+        deadline = time.monotonic() + SHARD_TIMEOUT
+
+    return results
+
+
+def _process_pending(broker, process: Callable, lock: threading.RLock) -> bool:
+    """Processes a pending sub-job, unless another distribution is running in this process
+
+    A sub-job is not taken while it would have to wait for the lock, so that other replicas can process it
+
+    :return: True if a sub-job has been processed
+    """
+    if not lock.acquire(blocking=False):
+        return False
+
+    try:
+        with broker.receive(SHARD_QUEUE) as msg:
+            if msg is not None:
+                process(msg)
+            return msg is not None
+    finally:
+        lock.release()
+
+
+def _aggregate(parts: List[Tuple[str, Optional[str]]], results: dict) -> dict:
+    summary = {'warnings': [], 'errors': []}
+
+    for index, (fileset, destination) in enumerate(parts):
+        if index in results:
+            summary['warnings'].extend(results[index]['warnings'])
+            summary['errors'].extend(results[index]['errors'])
+        else:
+            part = f"{fileset} to {destination}" if destination else fileset
+            summary['errors'].append(f"No result received for the distribution of {part}")
+
+    return summary
+
+
+def process_shard(msg: dict, broker, distribute: Callable):
+    """Processes a sub-job and sends its result to the reply queue of the job
+
+    Errors are reported in the result, so that the job does not have to wait for the sub-job.
+    The result contains the warnings and errors that have been logged by the sub-job only.
+
+    :param msg: sub-job message
+    :param broker:
+    :param distribute: distribute function
+    :return:
+    """
+    header = msg['header']
+
+    with job_log() as summary:
+        try:
+            distribute(catalogue=header['catalogue'], fileset=header['fileset'], destination=header['destination'])
+        except Exception as e:
+            logger.error(f"Distribution of {header['fileset']} failed: {e}")
+
+    broker.publish(header['shard']['reply_to'], {
+        'header': {'job_id': header['shard']['job_id'], 'index': header['shard']['index']},
+        'summary': summary
+    })
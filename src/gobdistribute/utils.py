@@ -1,4 +1,6 @@
+import importlib.util
 import json
+import sys
 from requests import Session
 from requests.adapters import HTTPAdapter, Retry
 from gobdistribute.config import EXPORT_API_HOST
@@ -17,3 +19,24 @@ def get_with_retries(url: str):
     retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
     session.mount(EXPORT_API_HOST, HTTPAdapter(max_retries=retries))
     return session.get(url)
+
+
+def lazy_import(name: str):
+    """Returns module name without executing it
+
+    The module is executed when one of its attributes is first accessed.
+    This keeps heavy dependencies (eg swiftclient, paramiko) out of the startup of the service.
+
+    :param name:
+    :return:
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,139 @@
+"""Workspace
+
+Temporary workspace for the files of a fileset
+
+Each fileset is downloaded in its own workspace directory, which is removed when the fileset has been
+distributed. Disk space is reserved before a file is downloaded, using the size from the Objectstore listing,
+and released as soon as the file has been distributed. Reservations are shared by all workspaces in the process.
+A reservation that would exceed the free disk space or the configured budget is put on hold until space is released.
+
+"""
+import contextlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from gobcore.exceptions import GOBException
+from gobcore.logging.logger import logger
+
+from gobdistribute.config import WORKSPACE_DIR, WORKSPACE_BUDGET, WORKSPACE_ADMISSION_TIMEOUT
+
+
+class Workspace:
+
+    # Bytes reserved by all workspaces in this process, and the part of it for files that are not yet written
+    _reserved = 0
+    _unwritten = 0
+    _condition = threading.Condition()
+
+    def __init__(self, name: str, base_dir: str = WORKSPACE_DIR, budget: int = WORKSPACE_BUDGET,
+                 timeout: float = WORKSPACE_ADMISSION_TIMEOUT):
+        """
+        :param name: name of the workspace, used as prefix for the workspace directory
+        :param base_dir: directory in which the workspace directory is created
+        :param budget: maximum number of bytes reserved by all workspaces, 0 for no maximum
+        :param timeout: maximum number of seconds a reservation is put on hold
+        """
+        self.name = name
+        self.base_dir = base_dir
+        self.budget = budget
+        self.timeout = timeout
+        self.path = None
+        self.reserved = 0
+        self.unwritten = 0
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix=f"{self.name}.", dir=self.base_dir)
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def cleanup(self):
+        """Removes the workspace directory and releases all space that has been reserved by the workspace
+
+        :return:
+        """
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+        with Workspace._condition:
+            Workspace._reserved -= self.reserved
+            Workspace._unwritten -= self.unwritten
+            self.reserved = 0
+            self.unwritten = 0
+            Workspace._condition.notify_all()
+
+    def release(self, path: str, size: int):
+        """Removes path from the workspace and releases the size bytes that have been reserved for it
+
+        :param path:
+        :param size:
+        :return:
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+        with Workspace._condition:
+            Workspace._reserved -= size
+            self.reserved -= size
+            Workspace._condition.notify_all()
+
+    def filepath(self, dst_path: str) -> str:
+        """Returns the local path for dst_path in the workspace, creates any missing directories
+
+        :param dst_path:
+        :return:
+        """
+        filepath = os.path.join(self.path, dst_path)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        return filepath
+
+    def reserve(self, size: int):
+        """Reserves size bytes of disk space in the workspace
+
+        The reservation is put on hold while it would exceed the free disk space or the budget.
+        Raises a GOBException when the reservation cannot be admitted.
+
+        :param size: number of bytes to reserve
+        :return:
+        """
+        if self.budget and size > self.budget:
+            raise GOBException(f"Workspace {self.name}: {size} bytes exceeds workspace budget of {self.budget} bytes")
+
+        deadline = time.monotonic() + self.timeout
+        with Workspace._condition:
+            while not self._admissible(size):
+                remaining = deadline - time.monotonic()
+                if Workspace._reserved == 0 or remaining <= 0:
+                    # Nothing will be released in time
+                    raise GOBException(f"Workspace {self.name}: insufficient space to reserve {size} bytes")
+
+                logger.info(f"Workspace {self.name}: hold reservation of {size} bytes until space is released")
+                Workspace._condition.wait(remaining)
+
+            Workspace._reserved += size
+            Workspace._unwritten += size
+            self.reserved += size
+            self.unwritten += size
+
+    def written(self, size: int):
+        """Registers that the file for a reservation of size bytes has been written
+
+        From then on the file is accounted for in the free disk space
+
+        :param size:
+        :return:
+        """
+        with Workspace._condition:
+            Workspace._unwritten -= size
+            self.unwritten -= size
+
+    def _admissible(self, size: int) -> bool:
+        if self.budget and Workspace._reserved + size > self.budget:
+            return False
+        # Space reserved for files that are still being written is not yet taken from the free disk space
+        return Workspace._unwritten + size <= shutil.disk_usage(self.base_dir).free
@@ -0,0 +1 @@
+VALUE = "value"
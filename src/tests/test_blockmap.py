@@ -0,0 +1,105 @@
+import hashlib
+import os
+import struct
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from gobdistribute.blockmap import block_map, write_block_map, md4, _md4, _rsum, _block_size, _hash_lengths
+
+
+class TestBlockMap(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.local_file = os.path.join(self.directory.name, 'file20201201.csv')
+
+        with open(self.local_file, 'wb') as f:
+            f.write(b'aaaabbbbcc')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_md4(self):
+        # RFC 1320 test suite
+        testcases = [
+            (b'', '31d6cfe0d16ae931b73c59d7e0c089c0'),
+            (b'a', 'bde52cb31de33e46245e05fbdbd6fb24'),
+            (b'abc', 'a448017aaf21d8525fc10ae87aa6729d'),
+            (b'message digest', 'd9130a8164549fe818874806e1c7014b'),
+            (b'abcdefghijklmnopqrstuvwxyz', 'd79e1c308aa5bbcdeea8ed63df412da9'),
+            (b'1234567890' * 8, 'e33b4ddc9c38f2199c3e7b164fcc0536'),
+        ]
+        for data, digest in testcases:
+            self.assertEqual(digest, _md4(data).hex(), data)
+
+    @patch('gobdistribute.blockmap.hashlib')
+    def test_md4_implementations(self, mock_hashlib):
+        mock_hashlib.algorithms_available = {'md4'}
+        self.assertEqual(mock_hashlib.new.return_value.digest.return_value, md4(b'abc'))
+        mock_hashlib.new.assert_called_with('md4', b'abc')
+
+        mock_hashlib.algorithms_available = set()
+        with patch('gobdistribute.blockmap.MD4', MagicMock()) as mock_md4:
+            self.assertEqual(mock_md4.new.return_value.digest.return_value, md4(b'abc'))
+            mock_md4.new.assert_called_with(b'abc')
+
+        with patch('gobdistribute.blockmap.MD4', None):
+            self.assertEqual('a448017aaf21d8525fc10ae87aa6729d', md4(b'abc').hex())
+
+    def test_rsum(self):
+        # a = 1 + 2 + 3, b = 3 * 1 + 2 * 2 + 1 * 3
+        self.assertEqual(struct.pack('>HH', 6, 10), _rsum(bytes([1, 2, 3])))
+        # Both sums are 16 bits
+        self.assertEqual(struct.pack('>HH', 255 * 300 & 0xffff, 255 * 300 * 301 // 2 & 0xffff),
+                         _rsum(bytes([255] * 300)))
+
+    def test_block_size(self):
+        self.assertEqual(2048, _block_size(10))
+        self.assertEqual(4096, _block_size(100_000_000))
+
+        with patch('gobdistribute.blockmap.BLOCK_MAP_BLOCK_SIZE', 65536):
+            self.assertEqual(65536, _block_size(10))
+
+    def test_hash_lengths(self):
+        self.assertEqual((1, 2, 3), _hash_lengths(0, 2048))
+        self.assertEqual((2, 2, 3), _hash_lengths(10, 4))
+        self.assertEqual((2, 3, 5), _hash_lengths(1_000_000_000, 4096))
+
+    def test_block_map(self):
+        control = block_map(self.local_file, 4)
+        header, checksums = control.split(b'\n\n', 1)
+
+        self.assertEqual([
+            'zsync: 0.6.2',
+            'Filename: file20201201.csv',
+            'Blocksize: 4',
+            'Length: 10',
+            'Hash-Lengths: 2,2,3',
+            'URL: file20201201.csv',
+            f"SHA-1: {hashlib.sha1(b'aaaabbbbcc').hexdigest()}",
+        ], header.decode().split('\n'))
+
+        # Per block the last 2 bytes of the rolling checksum and the first 3 bytes of the MD4 checksum,
+        # the last block is padded with zeros
+        blocks = [b'aaaa', b'bbbb', b'cc\0\0']
+        self.assertEqual(b''.join(_rsum(block)[2:] + _md4(block)[:3] for block in blocks), checksums)
+
+        # Default block size
+        self.assertIn(b'Blocksize: 2048\n', block_map(self.local_file))
+
+    def test_write_block_map(self):
+        block_map_file = write_block_map(self.local_file)
+
+        self.assertEqual(f'{self.local_file}.zsync', block_map_file)
+        with open(block_map_file, 'rb') as f:
+            self.assertEqual(block_map(self.local_file), f.read())
+
+        # Existing control files are reused
+        with open(block_map_file, 'w') as f:
+            f.write('existing')
+
+        self.assertEqual(block_map_file, write_block_map(self.local_file))
+        with open(block_map_file) as f:
+            self.assertEqual('existing', f.read())
@@ -1,17 +1,29 @@
 import json
+import os
+import tempfile
 
 from unittest import TestCase
-from unittest.mock import call, patch, MagicMock
+from unittest.mock import ANY, call, patch, MagicMock
 
 import requests.exceptions
+from gobcore.datastore.objectstore import ObjectDatastore
 from gobcore.exceptions import GOBException
 
 from gobdistribute.distribute import distribute, _download_sources, _distribute_files, _get_file, _get_config, \
-    ObjectDatastore, _get_filenames, _get_export_products, GOB_OBJECTSTORE, _get_datastore, \
-    _apply_filename_replacements, _expand_filename_wildcard, _distribute_file
+    _get_filenames, _get_export_products, GOB_OBJECTSTORE, _get_datastore, \
+    _apply_filename_replacements, _expand_filename_wildcard, _distribute_file, _listing_prefix, _put_file, \
+    _download_file, _Upload, _distribute_downloads, _distribute_fileset, _retry_deferred, \
+    _create_datastore, get_filesets, _select_filesets
+from gobdistribute.listing import ListingCache
+
+
+class SFTPClient(MagicMock):
+    pass
 
 
 @patch('gobdistribute.distribute.logger', MagicMock())
+@patch('gobdistribute.resilience.logger', MagicMock())
+@patch('gobdistribute.resilience.time.sleep', MagicMock())
 class TestDistribute(TestCase):
 
     @patch('gobdistribute.distribute._get_datastore')
@@ -20,18 +32,21 @@ class TestDistribute(TestCase):
     @patch('gobdistribute.distribute._get_export_products')
     @patch('gobdistribute.distribute._download_sources')
     @patch('gobdistribute.distribute._distribute_files')
+    @patch('gobdistribute.distribute.RunHistory', MagicMock())
+    @patch('gobdistribute.distribute.get_circuit_breaker', MagicMock())
+    @patch('gobdistribute.distribute.Workspace')
     @patch('gobdistribute.distribute.CONTAINER_BASE', 'THE_CONTAINER')
-    @patch('gobdistribute.distribute.tempfile.gettempdir', lambda: '/tmpdir')
-    def test_distribute(self, mock_distribute_files, mock_download_sources, mock_get_export_products, mock_get_filenames,
-                        mock_get_config, mock_get_datastore):
+    def test_distribute(self, mock_workspace, mock_distribute_files, mock_download_sources, mock_get_export_products,
+                        mock_get_filenames, mock_get_config, mock_get_datastore):
         catalogue = 'any catalogue'
         fileset = 'fileset_a'
 
         mock_get_datastore.return_value = (MagicMock(), 'BASE_DIR/')
-        mock_download_sources.return_value = [
-            ('dst_location/source1.csv', 'path/to/source1.csv'),
-            ('dst_location/source2.csv', 'path/to/source2.csv'),
+        mock_download_sources.side_effect = lambda *args: [
+            ('dst_location/source1.csv', 'path/to/source1.csv', 100),
+            ('dst_location/source2.csv', 'path/to/source2.csv', 200),
         ]
+        mock_distribute_files.return_value = {'files': 1, 'bytes': 100, 'skipped': 0}
 
         mock_get_config.return_value = {
             'fileset_a': {
@@ -51,18 +66,17 @@ class TestDistribute(TestCase):
 
         distribute(catalogue)
 
-        mapping_a = [
-            ('BASE_DIR/location/a/dst_location/source1.csv', 'path/to/source1.csv'),
-            ('BASE_DIR/location/a/dst_location/source2.csv', 'path/to/source2.csv'),
-        ]
-        mapping_b = [
-            ('BASE_DIR/location/b/dst_location/source1.csv', 'path/to/source1.csv'),
-            ('BASE_DIR/location/b/dst_location/source2.csv', 'path/to/source2.csv'),
-        ]
-        mapping_c = [
-            ('BASE_DIR/location/c/dst_location/source1.csv', 'path/to/source1.csv'),
-            ('BASE_DIR/location/c/dst_location/source2.csv', 'path/to/source2.csv'),
-        ]
+        datastore = mock_get_datastore.return_value[0]
+
+        # Each file is put on all destinations of its fileset when it has been downloaded
+        mock_distribute_files.assert_has_calls([
+            call(datastore, [('dst_location/source1.csv', 'path/to/source1.csv')], 'BASE_DIR/location/a', 'destA'),
+            call(datastore, [('dst_location/source1.csv', 'path/to/source1.csv')], 'BASE_DIR/location/b', 'destB'),
+            call(datastore, [('dst_location/source2.csv', 'path/to/source2.csv')], 'BASE_DIR/location/a', 'destA'),
+            call(datastore, [('dst_location/source2.csv', 'path/to/source2.csv')], 'BASE_DIR/location/b', 'destB'),
+            call(datastore, [('dst_location/source1.csv', 'path/to/source1.csv')], 'BASE_DIR/location/c', 'destC'),
+            call(datastore, [('dst_location/source2.csv', 'path/to/source2.csv')], 'BASE_DIR/location/c', 'destC'),
+        ])
 
         mock_get_datastore.assert_has_calls([
             call(GOB_OBJECTSTORE),
@@ -81,10 +95,13 @@ class TestDistribute(TestCase):
             call(conn_info, mock_get_config.return_value['fileset_a'], catalogue, mock_get_export_products.return_value),
             call(conn_info, mock_get_config.return_value['fileset_b'], catalogue, mock_get_export_products.return_value),
         ])
+        workspace = mock_workspace.return_value.__enter__.return_value
+        mock_workspace.assert_has_calls([call('fileset_a'), call('fileset_b')], any_order=True)
         mock_download_sources.assert_has_calls([
-            call(conn_info, '/tmpdir/fileset_a', mock_get_filenames()),
-            call(conn_info, '/tmpdir/fileset_b', mock_get_filenames()),
+            call(conn_info, workspace, mock_get_filenames(), False),
+            call(conn_info, workspace, mock_get_filenames(), False),
         ])
+        self.assertEqual(2, mock_workspace.return_value.__exit__.call_count)
         mock_get_export_products.assert_called_with(catalogue)
         mock_get_export_products.assert_called_once()
 
@@ -100,12 +117,57 @@ class TestDistribute(TestCase):
         ])
 
         mock_download_sources.assert_has_calls([
-            call(conn_info, '/tmpdir/fileset_a', mock_get_filenames()),
+            call(conn_info, workspace, mock_get_filenames(), False),
         ])
 
         mock_get_export_products.assert_called_with(catalogue)
         mock_get_export_products.assert_called_once()
 
+    @patch('gobdistribute.distribute.RunHistory')
+    @patch('gobdistribute.distribute._retry_deferred')
+    @patch('gobdistribute.distribute._distribute_fileset')
+    @patch('gobdistribute.distribute._get_export_products')
+    @patch('gobdistribute.distribute._get_config')
+    @patch('gobdistribute.distribute._get_datastore')
+    def test_distribute_deferred(self, mock_get_datastore, mock_get_config, mock_get_export_products,
+                                 mock_distribute_fileset, mock_retry_deferred, mock_run_history):
+        mock_get_datastore.return_value = (MagicMock(), '')
+        mock_get_config.return_value = {
+            'fileset_a': {'sources': [], 'destinations': [{'name': 'destA'}, {'name': 'destB'}]},
+            'fileset_b': {'sources': [], 'destinations': [{'name': 'destB'}]},
+        }
+        mock_distribute_fileset.side_effect = [[{'name': 'destB'}], []]
+
+        distribute('catalogue')
+
+        run = mock_run_history.return_value.recorded_run.return_value.__enter__.return_value
+        mock_run_history.return_value.recorded_run.assert_called_with('catalogue', None, None)
+
+        conn_info = {"connection": mock_get_datastore.return_value[0].connection, "container": 'development'}
+        mock_distribute_fileset.assert_has_calls([
+            call(conn_info, 'fileset_a', mock_get_config.return_value['fileset_a'], 'catalogue',
+                 mock_get_export_products.return_value, run),
+            call(conn_info, 'fileset_b', mock_get_config.return_value['fileset_b'], 'catalogue',
+                 mock_get_export_products.return_value, run),
+        ])
+        mock_retry_deferred.assert_called_with(conn_info, {
+            'fileset_a': {'sources': [], 'destinations': [{'name': 'destB'}]},
+        }, 'catalogue', mock_get_export_products.return_value, run)
+        mock_run_history.return_value.close.assert_called_once()
+
+        # A failed run is recorded with its error
+        mock_distribute_fileset.side_effect = GOBException("any error")
+        with self.assertRaises(GOBException):
+            distribute('catalogue')
+        mock_run_history.return_value.recorded_run.return_value.__exit__.assert_called_with(
+            GOBException, ANY, ANY)
+
+        # Runs of a single destination are recorded as such
+        mock_distribute_fileset.side_effect = None
+        mock_distribute_fileset.return_value = []
+        distribute('catalogue', 'fileset_a', 'destA')
+        mock_run_history.return_value.recorded_run.assert_called_with('catalogue', 'fileset_a', 'destA')
+
     @patch('gobdistribute.distribute.get_with_retries')
     @patch('gobdistribute.distribute.EXPORT_API_HOST', 'http://exportapihost')
     def test_get_export_products(self, mock_get):
@@ -127,46 +189,78 @@ class TestDistribute(TestCase):
         with self.assertRaisesRegex(GOBException, "Fetching export products from GOB-Export failed"):
             _get_export_products('some cat')
 
-    @patch('gobdistribute.distribute.get_full_container_list')
+    @patch('gobdistribute.distribute.objectstore.get_full_container_list')
     def test_expand_filename_wildcard(self, mock_get_list):
         conn_info = {'connection': 'CONNECTION', 'container': 'CONTAINER'}
+        # Objectstore listings are sorted by name
         mock_get_list.return_value = [
+            {'name': 'anotherdir/a.csv', 'content_type': ''},
+            {'name': 'anotherdir/b.shp', 'content_type': ''},
+            {'name': 'dir', 'content_type': 'application/directory'},  # should be ignored
             {'name': 'dir/a.csv', 'content_type': ''},
-            {'name': 'dir/b.csv', 'content_type': ''},
             {'name': 'dir/a.shp', 'content_type': ''},
-            {'name': 'dir', 'content_type': 'application/directory'},  # should be ignored
+            {'name': 'dir/b.csv', 'content_type': ''},
             {'name': 'dir/b.shp', 'content_type': ''},
-            {'name': 'anotherdir/a.csv', 'content_type': ''},
-            {'name': 'anotherdir/b.shp', 'content_type': ''},
         ]
 
         self.assertEqual([
             'dir/a.csv',
             'dir/b.csv',
-        ], _expand_filename_wildcard(conn_info, 'dir/*.csv'))
+        ], list(_expand_filename_wildcard(conn_info, 'dir/*.csv')))
 
         self.assertEqual([
             'dir/a.csv',
             'dir/a.shp',
-        ], _expand_filename_wildcard(conn_info, 'dir/a.*'))
+        ], list(_expand_filename_wildcard(conn_info, 'dir/a.*')))
 
         self.assertEqual([
             'dir/a.csv',
-            'dir/b.csv',
             'dir/a.shp',
+            'dir/b.csv',
             'dir/b.shp',
-        ], _expand_filename_wildcard(conn_info, 'dir/*'))
+        ], list(_expand_filename_wildcard(conn_info, 'dir/*')))
 
         self.assertEqual([
+            'anotherdir/a.csv',
+            'anotherdir/b.shp',
             'dir/a.csv',
-            'dir/b.csv',
             'dir/a.shp',
+            'dir/b.csv',
             'dir/b.shp',
-            'anotherdir/a.csv',
-            'anotherdir/b.shp',
-        ], _expand_filename_wildcard(conn_info, '*'))
+        ], list(_expand_filename_wildcard(conn_info, '*')))
 
-        mock_get_list.assert_called_with('CONNECTION', 'CONTAINER')
+        mock_get_list.assert_called_with('CONNECTION', 'CONTAINER', prefix='')
+
+        # The listing is filtered on the prefix by the Objectstore
+        list(_expand_filename_wildcard(conn_info, 'dir/*.csv'))
+        mock_get_list.assert_called_with('CONNECTION', 'CONTAINER', prefix='dir/')
+
+    @patch('gobdistribute.distribute.objectstore.get_full_container_list')
+    def test_expand_filename_wildcard_early_termination(self, mock_get_list):
+        conn_info = {'connection': 'CONNECTION', 'container': 'CONTAINER'}
+
+        def listing():
+            yield {'name': 'a/x.csv', 'content_type': ''}
+            yield {'name': 'dir/a.csv', 'content_type': ''}
+            yield {'name': 'other/a.csv', 'content_type': ''}
+            raise AssertionError("Listing should not be read beyond the matching prefix")
+
+        mock_get_list.return_value = listing()
+
+        result = _expand_filename_wildcard(conn_info, 'dir/*.csv')
+        self.assertEqual('dir/a.csv', next(result))
+        self.assertEqual([], list(result))
+
+    def test_listing_prefix(self):
+        testcases = [
+            ('dir/*.csv', 'dir/'),
+            ('dir/file{DATE}.csv', 'dir/file'),
+            ('dir/file', 'dir/file'),
+            ('*', ''),
+        ]
+
+        for inp, outp in testcases:
+            self.assertEqual(outp, _listing_prefix(inp))
 
     @patch('gobdistribute.distribute._expand_filename_wildcard')
     def test_get_filenames(self, mock_expand_wildcard):
@@ -237,57 +331,364 @@ class TestDistribute(TestCase):
             ('catalog1/file3.dat', 'catalog1/file3.dat'),
             ('catalog1/file5.csv', 'catalog1/file5.csv'),
             ('catalog1/file6.shp', 'catalog1/file6.shp')
-        ], _get_filenames(conn_info, config, 'catalog1', export_products))
+        ], list(_get_filenames(conn_info, config, 'catalog1', export_products)))
         mock_expand_wildcard.assert_called_with(conn_info, 'some/dir/*.csv')
 
-    @patch('gobdistribute.distribute.Path')
-    @patch('gobdistribute.distribute._get_file')
-    def test_download_sources(self, mock_get_file, mock_path):
+    @patch('gobdistribute.distribute._download_file')
+    @patch('gobdistribute.distribute._find_file')
+    def test_download_sources(self, mock_find_file, mock_download_file):
         filenames = [
             ('some/dir/any filename', 'src/file/name1.csv'),
             ('some/other/dir/another filename', 'src/file/name2.csv')
         ]
 
-        mock_get_file.side_effect = [
-            ({'name': 'any file'}, 'any file'),
-            ({'name': 'another file found with a different name'}, 'another file')
+        mock_find_file.side_effect = [
+            {'name': 'any file', 'bytes': 100},
+            {'name': 'another file found with a different name'},
         ]
+        workspace = MagicMock()
+        workspace.filepath.side_effect = lambda dst_path: f'any directory/{dst_path}'
 
-        with patch("builtins.open") as mock_open:
-            res = _download_sources('any connection', 'any directory', filenames)
+        downloads = _download_sources('any connection', workspace, filenames)
 
-            self.assertEqual([
-                call('any connection', 'src/file/name1.csv'),
-                call('any connection', 'src/file/name2.csv'),
-            ],
-                mock_get_file.mock_calls,
-                "The method was not called with the correct arguments."
-            )
+        # Each file is downloaded when the next download is requested
+        self.assertEqual(('some/dir/any filename', 'any directory/some/dir/any filename', 100), next(downloads))
+        mock_download_file.assert_called_once()
 
         self.assertEqual([
-            ('some/dir/any filename', 'any directory/some/dir/any filename'),
-            ('some/other/dir/another filename', 'any directory/some/other/dir/another filename'),
-        ], res)
+            ('some/other/dir/another filename', 'any directory/some/other/dir/another filename', 0),
+        ], list(downloads))
+
+        self.assertEqual([
+            call('any connection', 'src/file/name1.csv'),
+            call('any connection', 'src/file/name2.csv'),
+        ],
+            mock_find_file.mock_calls,
+            "The method was not called with the correct arguments."
+        )
+
+        workspace.reserve.assert_has_calls([call(100), call(0)])
+        workspace.written.assert_has_calls([call(100), call(0)])
+        mock_download_file.assert_has_calls([
+            call('any connection', {'name': 'any file', 'bytes': 100}, 'any directory/some/dir/any filename'),
+            call('any connection', {'name': 'another file found with a different name'},
+                 'any directory/some/other/dir/another filename'),
+        ])
+
+    @patch('gobdistribute.distribute.write_block_map')
+    @patch('gobdistribute.distribute._download_file')
+    @patch('gobdistribute.distribute._find_file')
+    def test_download_sources_block_maps(self, mock_find_file, mock_download_file, mock_write_block_map):
+        mock_find_file.return_value = {'name': 'any file', 'bytes': 100}
+        workspace = MagicMock()
+
+        downloads = _download_sources('any connection', workspace, [('dst', 'src')], block_maps=True)
+
+        # The control file is written by the download
+        self.assertEqual(('dst', workspace.filepath.return_value, 100), next(downloads))
+        mock_write_block_map.assert_called_once_with(workspace.filepath.return_value)
+
+    @patch('gobdistribute.distribute._download_file')
+    @patch('gobdistribute.distribute._find_file')
+    def test_download_sources_retry(self, mock_find_file, mock_download_file):
+        mock_find_file.side_effect = [ConnectionResetError, {'name': 'any file', 'bytes': 100}]
+        mock_download_file.side_effect = [TimeoutError, None]
+        workspace = MagicMock()
+
+        res = list(_download_sources('any connection', workspace, [('dst', 'src')]))
+
+        self.assertEqual([('dst', workspace.filepath.return_value, 100)], res)
+        self.assertEqual(2, mock_find_file.call_count)
+        self.assertEqual(2, mock_download_file.call_count)
+        workspace.reserve.assert_called_once_with(100)
+
+    @patch('gobdistribute.distribute._find_file', lambda conn_info, filename: None)
+    def test_download_sources_not_found(self):
+        workspace = MagicMock()
+
+        with self.assertRaisesRegex(GOBException, "Source file src/file.csv not found"):
+            list(_download_sources('any connection', workspace, [('dst', 'src/file.csv')]))
+        workspace.reserve.assert_not_called()
+
+    @patch('gobdistribute.distribute.objectstore.get_object')
+    def test_download_file(self, mock_get_object):
+        conn_info = {'connection': 'any connection', 'container': 'any container'}
+        mock_get_object.return_value = iter([b'chunk1', b'chunk2'])
+
+        with patch("builtins.open") as mock_open:
+            _download_file(conn_info, {'name': 'any file'}, 'local file')
+
+        mock_get_object.assert_called_with('any connection', {'name': 'any file'}, 'any container')
+        mock_open.assert_called_with('local file', 'wb')
+        mock_open.return_value.__enter__.return_value.write.assert_has_calls([call(b'chunk1'), call(b'chunk2')])
+
+    @patch('gobdistribute.distribute._distribute_files')
+    @patch('gobdistribute.distribute._get_datastore')
+    @patch('gobdistribute.distribute.get_circuit_breaker')
+    def test_upload(self, mock_get_circuit_breaker, mock_get_datastore, mock_distribute_files):
+        circuit_breaker = mock_get_circuit_breaker.return_value
+        datastore = MagicMock()
+        mock_get_datastore.side_effect = [ConnectionResetError, (datastore, 'BASE_DIR/')]
+        mock_distribute_files.return_value = {'files': 1, 'bytes': 100, 'skipped': 0}
+
+        upload = _Upload({'name': 'destA', 'location': 'location/a'})
+        mock_get_circuit_breaker.assert_called_with('destA')
+
+        # Connect on the first file, with retries
+        upload.put('dst1', 'local1')
+        upload.put('dst2', 'local2')
+
+        self.assertEqual(2, mock_get_datastore.call_count)
+        mock_get_datastore.assert_called_with('destA')
+        mock_distribute_files.assert_has_calls([
+            call(datastore, [('dst1', 'local1')], 'BASE_DIR/location/a', 'destA'),
+            call(datastore, [('dst2', 'local2')], 'BASE_DIR/location/a', 'destA'),
+        ])
+
+        self.assertEqual({'files': 2, 'bytes': 200, 'skipped': 0, 'error': None}, upload.close())
+        circuit_breaker.record_success.assert_called_once()
+        datastore.disconnect.assert_called_once()
 
-        mock_open.assert_has_calls([
-            call('any directory/some/dir/any filename', 'wb'),
-            call('any directory/some/other/dir/another filename', 'wb'),
-        ], True)
+        # Other errors are raised
+        datastore.can_delete_file.return_value = False
+        mock_get_datastore.side_effect = None
+        mock_get_datastore.return_value = (datastore, 'BASE_DIR/')
+        with self.assertRaisesRegex(AssertionError, "Datastore does not support file deletions"):
+            _Upload({'name': 'destA', 'location': 'location/a'}).put('dst1', 'local1')
+
+    @patch('gobdistribute.distribute._distribute_files')
+    @patch('gobdistribute.distribute._get_datastore')
+    @patch('gobdistribute.distribute.get_circuit_breaker')
+    def test_upload_transient_error(self, mock_get_circuit_breaker, mock_get_datastore, mock_distribute_files):
+        circuit_breaker = mock_get_circuit_breaker.return_value
+        datastore = MagicMock()
+        mock_get_datastore.return_value = (datastore, 'BASE_DIR/')
+        mock_distribute_files.side_effect = [{'files': 1, 'bytes': 100, 'skipped': 0}, ConnectionRefusedError]
+
+        upload = _Upload({'name': 'destA', 'location': 'location/a'})
+        upload.put('dst1', 'local1')
+        upload.put('dst2', 'local2')
+
+        # The remaining files are not put
+        upload.put('dst3', 'local3')
+        self.assertEqual(2, mock_distribute_files.call_count)
+
+        self.assertEqual({'files': 1, 'bytes': 100, 'skipped': 0, 'error': 'ConnectionRefusedError()'}, upload.close())
+        circuit_breaker.record_failure.assert_called_once()
+        circuit_breaker.record_success.assert_not_called()
+        datastore.disconnect.assert_called_once()
+
+    @patch('gobdistribute.distribute._get_datastore')
+    @patch('gobdistribute.distribute.get_circuit_breaker')
+    def test_upload_on_hold(self, mock_get_circuit_breaker, mock_get_datastore):
+        mock_get_circuit_breaker.return_value.allow.return_value = False
+
+        upload = _Upload({'name': 'destA', 'location': 'location/a'})
+        upload.put('dst1', 'local1')
+
+        mock_get_datastore.assert_not_called()
+        self.assertEqual({'files': 0, 'bytes': 0, 'skipped': 0, 'error': 'Destination on hold'}, upload.close())
+
+    @patch('gobdistribute.distribute.write_block_map', lambda local_file: f'{local_file}.zsync')
+    @patch('gobdistribute.distribute._distribute_files')
+    @patch('gobdistribute.distribute._get_datastore')
+    @patch('gobdistribute.distribute.get_circuit_breaker', MagicMock())
+    def test_upload_delta(self, mock_get_datastore, mock_distribute_files):
+        datastore = MagicMock()
+        mock_get_datastore.return_value = (datastore, 'BASE_DIR/')
+        mock_distribute_files.return_value = {'files': 1, 'bytes': 100, 'skipped': 0}
+
+        upload = _Upload({'name': 'destA', 'location': 'location/a', 'delta': True})
+        upload.put('dst/file20201201.csv', '/tmp/file20201201.csv')
+
+        mock_distribute_files.assert_has_calls([
+            call(datastore, [('dst/file20201201.csv', '/tmp/file20201201.csv')], 'BASE_DIR/location/a', 'destA'),
+            call(datastore, [('dst/file20201201.csv.zsync', '/tmp/file20201201.csv.zsync')], 'BASE_DIR/location/a',
+                 'destA'),
+        ])
+
+        # The control file is not counted
+        self.assertEqual({'files': 1, 'bytes': 100, 'skipped': 0, 'error': None}, upload.close())
+
+        # No control file is put for a file that has been skipped
+        mock_distribute_files.reset_mock()
+        mock_distribute_files.return_value = {'files': 0, 'bytes': 0, 'skipped': 1}
+        upload.put('dst/file20201202.csv', '/tmp/file20201202.csv')
+        mock_distribute_files.assert_called_once()
+
+    @patch('gobdistribute.distribute._Upload')
+    @patch('gobdistribute.distribute._distribute_downloads')
+    @patch('gobdistribute.distribute._download_sources')
+    @patch('gobdistribute.distribute._get_filenames')
+    @patch('gobdistribute.distribute.Workspace')
+    def test_distribute_fileset(self, mock_workspace, mock_get_filenames, mock_download_sources,
+                                mock_distribute_downloads, mock_upload):
+        config = {
+            'destinations': [
+                {'name': 'destA', 'location': 'location/a'},
+                {'name': 'destB', 'location': 'location/b', 'delta': True},
+            ]
+        }
+        upload_a = MagicMock(destination=config['destinations'][0], duration=1, result={'error': None})
+        upload_a.name = 'destA'
+        upload_a.close.return_value = {'error': None}
+        # No control files are written for a delta destination that is on hold
+        upload_b = MagicMock(destination=config['destinations'][1], duration=2, result={'error': 'Destination on hold'})
+        upload_b.name = 'destB'
+        upload_b.close.return_value = {'error': 'Destination on hold'}
+        mock_upload.side_effect = [upload_a, upload_b]
+        mock_distribute_downloads.return_value = (2, 300)
+        workspace = mock_workspace.return_value.__enter__.return_value
+        run = MagicMock()
+
+        result = _distribute_fileset('conn info', 'fileset_a', config, 'catalogue', 'export products', run)
+
+        self.assertEqual([config['destinations'][1]], result)
+        mock_upload.assert_has_calls([call(config['destinations'][0]), call(config['destinations'][1])])
+        mock_download_sources.assert_called_with('conn info', workspace, mock_get_filenames.return_value, False)
+        mock_distribute_downloads.assert_called_with(mock_download_sources.return_value, [upload_a, upload_b],
+                                                     workspace)
+        run.record_fileset.assert_called_with('fileset_a', 2, 300, ANY, False)
+        run.record_destination.assert_has_calls([
+            call('fileset_a', 'destA', {'error': None}, 1),
+            call('fileset_a', 'destB', {'error': 'Destination on hold'}, 2),
+        ])
+
+        # On a failing source all destinations are disconnected and the error is raised
+        upload_a.reset_mock()
+        upload_b.reset_mock()
+        run.reset_mock()
+        mock_upload.side_effect = [upload_a, upload_b]
+        mock_distribute_downloads.side_effect = GOBException("Source file not found")
+        config['destinations'][0]['delta'] = True
+
+        with self.assertRaisesRegex(GOBException, "Source file not found"):
+            _distribute_fileset('conn info', 'fileset_a', config, 'catalogue', 'export products', run)
+
+        mock_download_sources.assert_called_with('conn info', workspace, mock_get_filenames.return_value, True)
+
+        upload_a.disconnect.assert_called_once()
+        upload_b.disconnect.assert_called_once()
+        upload_a.close.assert_not_called()
+        run.record_destination.assert_not_called()
+
+    @patch('gobdistribute.distribute.PIPELINE_QUEUE_SIZE', 1)
+    def test_distribute_downloads(self):
+        workspace = MagicMock()
+        uploads = [MagicMock(), MagicMock()]
+        downloads = [('dst1', 'local1', 100), ('dst2', 'local2', 200)]
+
+        self.assertEqual((2, 300), _distribute_downloads(downloads, uploads, workspace))
+
+        for upload in uploads:
+            upload.put.assert_has_calls([call('dst1', 'local1'), call('dst2', 'local2')])
+        workspace.release.assert_has_calls([
+            call('local1', 100), call('local1.zsync', 0), call('local2', 200), call('local2.zsync', 0)
+        ])
+
+    def test_distribute_downloads_failure(self):
+        workspace = MagicMock()
+        upload = MagicMock()
+        upload.put.side_effect = [None, AssertionError]
+        downloads = [('dst1', 'local1', 100), ('dst2', 'local2', 200), ('dst3', 'local3', 300)]
+
+        with self.assertRaises(AssertionError):
+            _distribute_downloads(downloads, [upload], workspace)
+
+        # The failed file and the files that have been downloaded but not distributed are released
+        workspace.release.assert_has_calls([call('local1', 100), call('local2', 200), call('local3', 300)],
+                                           any_order=True)
+
+        # Download failures are raised after the files that have been downloaded before
+        def failing_downloads():
+            yield 'dst1', 'local1', 100
+            raise GOBException("insufficient space")
+
+        upload.put.side_effect = None
+        with self.assertRaisesRegex(GOBException, "insufficient space"):
+            _distribute_downloads(failing_downloads(), [upload], workspace)
+        upload.put.assert_called_with('dst1', 'local1')
+
+    @patch('gobdistribute.distribute._distribute_fileset')
+    @patch('gobdistribute.distribute.get_circuit_breaker')
+    def test_retry_deferred(self, mock_get_circuit_breaker, mock_distribute_fileset):
+        deferred = {
+            'fileset_a': {'sources': [], 'destinations': [{'name': 'destA'}]},
+            'fileset_b': {'sources': [], 'destinations': [{'name': 'destB'}]},
+        }
+        mock_get_circuit_breaker.side_effect = lambda name: MagicMock(**{'allow.return_value': name == 'destA'})
+        mock_distribute_fileset.return_value = [{'name': 'destA'}]
+
+        with patch('gobdistribute.distribute.logger') as mock_logger:
+            _retry_deferred('conn info', deferred, 'catalogue', 'export products', 'run')
+
+        # Only retry filesets for destinations that are not on hold
+        mock_distribute_fileset.assert_called_once_with('conn info', 'fileset_a', deferred['fileset_a'], 'catalogue',
+                                                        'export products', 'run', retry=True)
+        mock_logger.error.assert_has_calls([
+            call('Distribution of fileset fileset_a to destA failed, '
+                 'it will not be retried before the next distribution of catalogue'),
+            call('Distribution of fileset fileset_b to destB failed, '
+                 'it will not be retried before the next distribution of catalogue'),
+        ])
 
     @patch('gobdistribute.distribute.get_datastore_config')
-    @patch('gobdistribute.distribute.DatastoreFactory.get_datastore')
+    @patch('gobdistribute.distribute._create_datastore')
     @patch('gobdistribute.distribute.CONTAINER_BASE', "containerbase")
-    def test_get_datastore(self, mock_get_datastore, mock_get_datastore_config):
+    def test_get_datastore(self, mock_create_datastore, mock_get_datastore_config):
         res = _get_datastore('any name')
         mock_get_datastore_config.assert_called_with('any name')
-        mock_get_datastore.assert_called_with(mock_get_datastore_config.return_value)
-        mock_get_datastore().connect.assert_called_once()
+        mock_create_datastore.assert_called_with(mock_get_datastore_config.return_value)
+        mock_create_datastore().connect.assert_called_once()
 
-        self.assertEqual((mock_get_datastore(), "containerbase/"), res)
+        self.assertEqual((mock_create_datastore(), "containerbase/"), res)
 
         # Type ObjectDatastore, no base dir
-        mock_get_datastore.return_value = MagicMock(spec=ObjectDatastore)
-        self.assertEqual((mock_get_datastore(), ""), _get_datastore('any name'))
+        mock_create_datastore.return_value = MagicMock(spec=ObjectDatastore)
+        self.assertEqual((mock_create_datastore(), ""), _get_datastore('any name'))
+
+    @patch('gobdistribute.distribute.importlib.import_module')
+    def test_create_datastore(self, mock_import_module):
+        config = {'type': 'sftp'}
+
+        datastore = _create_datastore(config)
+
+        mock_import_module.assert_called_with('gobcore.datastore.sftp')
+        mock_import_module.return_value.SFTPDatastore.assert_called_with(config)
+        self.assertEqual(mock_import_module.return_value.SFTPDatastore.return_value, datastore)
+
+    @patch('gobcore.datastore.factory.DatastoreFactory.get_datastore')
+    def test_create_datastore_factory(self, mock_get_datastore):
+        # Other types are created by the DatastoreFactory
+        self.assertEqual(mock_get_datastore.return_value, _create_datastore({'type': 'postgres'}))
+        mock_get_datastore.assert_called_with({'type': 'postgres'})
+
+    @patch('gobdistribute.distribute._get_datastore')
+    @patch('gobdistribute.distribute._get_config')
+    @patch('gobdistribute.distribute.CONTAINER_BASE', 'THE_CONTAINER')
+    def test_get_filesets(self, mock_get_config, mock_get_datastore):
+        mock_datastore = MagicMock()
+        mock_get_datastore.return_value = mock_datastore, None
+
+        self.assertEqual(mock_get_config.return_value, get_filesets('cat'))
+        mock_get_config.assert_called_with({'connection': mock_datastore.connection, 'container': 'THE_CONTAINER'},
+                                           'cat', 'THE_CONTAINER')
+        mock_datastore.disconnect.assert_called_once()
+
+    def test_select_filesets(self):
+        filesets = {
+            'fs1': {'sources': ['a'], 'destinations': [{'name': 'destA'}, {'name': 'destB'}]},
+            'fs2': {'sources': ['b'], 'destinations': [{'name': 'destB'}]},
+        }
+
+        self.assertEqual(filesets, _select_filesets(filesets))
+        self.assertEqual({'fs2': filesets['fs2']}, _select_filesets(filesets, 'fs2'))
+        self.assertEqual({
+            'fs1': {'sources': ['a'], 'destinations': [{'name': 'destA'}]},
+            'fs2': {'sources': ['b'], 'destinations': []},
+        }, _select_filesets(filesets, destination='destA'))
+        self.assertEqual({'fs1': {'sources': ['a'], 'destinations': [{'name': 'destB'}]}},
+                         _select_filesets(filesets, 'fs1', 'destB'))
 
     def test_apply_filename_replacements(self):
         testcases = [
@@ -298,6 +699,9 @@ class TestDistribute(TestCase):
         for inp, outp in testcases:
             self.assertEqual(outp, _apply_filename_replacements(inp))
 
+    @patch('gobdistribute.distribute.listing_cache',
+           ListingCache(ttl=300, normalize=_apply_filename_replacements))
+    @patch('gobdistribute.distribute.os.path.getsize', lambda local_file: 100)
     @patch('gobdistribute.distribute._distribute_file')
     def test_distribute_files(self, mock_distribute_file):
         datastore = MagicMock(spec=ObjectDatastore)
@@ -310,8 +714,10 @@ class TestDistribute(TestCase):
             ('a/b/dstfile.txt', 'somelocalfile.txt'),
             ('a/b/file11112233.txt', 'someotherlocalfile.txt'),
         ]
+        mock_distribute_file.return_value = True
 
-        _distribute_files(datastore, mapping, 'some/dir')
+        result = _distribute_files(datastore, mapping, 'some/dir', 'destA')
+        self.assertEqual({'files': 2, 'bytes': 200, 'skipped': 0}, result)
 
         mock_distribute_file.assert_has_calls([
             call(datastore, 'somelocalfile.txt', 'some/dir/a/b/dstfile.txt', []),
@@ -320,6 +726,36 @@ class TestDistribute(TestCase):
                 'some/dir/a/b/file90123453.txt',
             ])
         ])
+        datastore.list_files.assert_called_once_with('some/dir')
+
+        # The second distribution uses the cached listing, updated with the puts and deletes of the first
+        mock_distribute_file.reset_mock()
+        mapping = [
+            ('a/b/file11112234.txt', 'someotherlocalfile.txt'),
+        ]
+
+        _distribute_files(datastore, mapping, 'some/dir', 'destA')
+
+        mock_distribute_file.assert_called_once_with(datastore, 'someotherlocalfile.txt',
+                                                     'some/dir/a/b/file11112234.txt',
+                                                     ['some/dir/a/b/file11112233.txt'])
+        datastore.list_files.assert_called_once()
+
+        # A skipped distribution invalidates the cached listing
+        mock_distribute_file.return_value = False
+        result = _distribute_files(datastore, mapping, 'some/dir', 'destA')
+        self.assertEqual({'files': 0, 'bytes': 0, 'skipped': 1}, result)
+        _distribute_files(datastore, mapping, 'some/dir', 'destA')
+        self.assertEqual(2, datastore.list_files.call_count)
+
+        # So does a failing distribution
+        mock_distribute_file.side_effect = OSError
+        with self.assertRaises(OSError):
+            _distribute_files(datastore, mapping, 'some/dir', 'destA')
+
+        mock_distribute_file.side_effect = None
+        _distribute_files(datastore, mapping, 'some/dir', 'destA')
+        self.assertEqual(4, datastore.list_files.call_count)
 
     def test_distribute_file(self):
         datastore = MagicMock(spec=ObjectDatastore)
@@ -330,25 +766,84 @@ class TestDistribute(TestCase):
             'existingfile2.txt',
         ]
 
-        _distribute_file(datastore, local_file, destination_filename, existing_files)
+        self.assertTrue(_distribute_file(datastore, local_file, destination_filename, existing_files))
         datastore.delete_file.assert_has_calls([
             call('existingfile1.txt'),
             call('existingfile2.txt'),
         ])
         datastore.put_file.assert_called_with('localfile.txt', 'destination_file.txt')
 
+        # Files that have already been deleted by others are ignored
         datastore.delete_file.reset_mock()
         datastore.put_file.reset_mock()
-        datastore.delete_file.side_effect = OSError
+        not_found = Exception("Object DELETE failed")
+        not_found.http_status = 404
+        datastore.delete_file.side_effect = [FileNotFoundError, not_found]
 
-        _distribute_file(datastore, local_file, destination_filename, existing_files)
+        self.assertTrue(_distribute_file(datastore, local_file, destination_filename, existing_files))
+        self.assertEqual(2, datastore.delete_file.call_count)
+        datastore.put_file.assert_called_with('localfile.txt', 'destination_file.txt')
+
+        # Other errors are raised
+        datastore.put_file.reset_mock()
+        datastore.delete_file.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            _distribute_file(datastore, local_file, destination_filename, existing_files)
+        datastore.put_file.assert_not_called()
+
+        datastore.delete_file.reset_mock()
+        datastore.put_file.reset_mock()
+        datastore.delete_file.side_effect = PermissionError
+
+        self.assertFalse(_distribute_file(datastore, local_file, destination_filename, existing_files))
         datastore.delete_file.assert_has_calls([
             call('existingfile1.txt'),
         ])
         datastore.put_file.assert_not_called()
 
-    @patch('gobdistribute.distribute.get_object')
-    @patch('gobdistribute.distribute.get_full_container_list')
+        # Transient errors are raised once the retries have run out, to defer the destination
+        datastore.delete_file.side_effect = OSError("Socket is closed")
+
+        with self.assertRaises(OSError):
+            _distribute_file(datastore, local_file, destination_filename, existing_files)
+        datastore.put_file.assert_not_called()
+
+    def test_put_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            local_file = os.path.join(directory, 'file.csv')
+            with open(local_file, 'wb') as f:
+                f.write(b'contents')
+
+            # The datastore puts the file if it has no SFTP connection
+            datastore = MagicMock(spec=ObjectDatastore)
+            _put_file(datastore, local_file, 'dir/file.csv')
+            datastore.put_file.assert_called_with(local_file, 'dir/file.csv')
+
+            # SFTP destinations are written from a memory map of the file
+            sftp = SFTPClient()
+            sftp.stat.side_effect = [FileNotFoundError, FileNotFoundError, None]
+            sftp.putfo.side_effect = lambda view, path, file_size: self.assertEqual(b'contents', view.read())
+            datastore = MagicMock(connection=sftp)
+
+            _put_file(datastore, local_file, 'base/dir/sub/file.csv')
+            sftp.stat.assert_has_calls([call('base/dir/sub'), call('base/dir'), call('base')])
+            sftp.mkdir.assert_has_calls([call('base/dir'), call('base/dir/sub')])
+            sftp.putfo.assert_called_once_with(ANY, 'base/dir/sub/file.csv', file_size=8)
+            datastore.put_file.assert_not_called()
+
+            sftp.reset_mock()
+            _put_file(datastore, local_file, 'file.csv')
+            sftp.stat.assert_not_called()
+            sftp.putfo.assert_called_once_with(ANY, 'file.csv', file_size=8)
+
+            # Empty files cannot be mapped
+            open(local_file, 'wb').close()
+            _put_file(datastore, local_file, '/file.csv')
+            datastore.put_file.assert_called_with(local_file, '/file.csv')
+
+    @patch('gobdistribute.distribute.objectstore.get_object')
+    @patch('gobdistribute.distribute.objectstore.get_full_container_list')
     def test_get_file(self, mock_get_full_container_list, mock_get_object):
         conn_info = {
             'connection': "any connection",
@@ -379,6 +874,26 @@ class TestDistribute(TestCase):
         mock_get_object.return_value = "get object"
         obj_info, obj = _get_file(conn_info, filename)
         self.assertEqual(obj_info, {'name': '20201103yz', 'last_modified': '300'})
+        mock_get_object.assert_called_with('any connection', obj_info, 'any container')
+
+        # Stop reading the listing once the names have passed the filename prefix
+        filename = "dir/file20201201.csv"
+        mock_get_object.reset_mock()
+        mock_get_full_container_list.return_value = iter([
+            {'name': 'a/file20201101.csv', 'last_modified': '100'},
+            {'name': 'dir/file20201101.csv', 'last_modified': '100'},
+            {'name': 'dir/file20201102.csv', 'last_modified': '200'},
+            {'name': 'dir/other.csv', 'last_modified': '300'},
+            {'name': 'z/file20201103.csv', 'last_modified': '300'},
+            {'name': 'z/file20201104.csv', 'last_modified': '400'},
+        ])
+        obj_info, obj = _get_file(conn_info, filename)
+        self.assertEqual(obj_info, {'name': 'dir/file20201102.csv', 'last_modified': '200'})
+        mock_get_object.assert_called_once()
+        mock_get_full_container_list.assert_called_with('any connection', 'any container', prefix='dir/file')
+        self.assertEqual(next(mock_get_full_container_list.return_value), {
+            'name': 'z/file20201103.csv', 'last_modified': '300'
+        })
 
     @patch('gobdistribute.distribute._get_file')
     def test_get_config(self, mock_get_file):
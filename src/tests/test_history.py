@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from gobdistribute.history import RunHistory, report
+
+
+@patch('gobdistribute.history.logger', MagicMock())
+class TestHistory(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.sqlite')
+        self.history = RunHistory(self.path)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def _run(self, catalogue, started_at, duration, dest_duration, error=None, destination=None):
+        with patch('gobdistribute.history.time.time', return_value=started_at):
+            run = self.history.start_run(catalogue, destination=destination)
+            run.record_fileset('fileset_a', 2, 2_000_000, 1.0)
+            run.record_destination('fileset_a', 'destA', {'files': 2, 'bytes': 2_000_000, 'skipped': 0,
+                                                          'error': error}, dest_duration)
+
+        with patch('gobdistribute.history.time.time', return_value=started_at + duration):
+            run.finish()
+        return run
+
+    def test_run(self):
+        run = self._run('cat', 1000, 10, 5, error='ConnectionResetError()')
+
+        # Unfinished runs are not returned
+        self.history.start_run('cat', 'fileset_a')
+
+        self.assertEqual([{
+            'id': run.id,
+            'catalogue': 'cat',
+            'fileset': None,
+            'destination': None,
+            'started_at': 1000,
+            'duration': 10,
+            'errors': 1,
+            'error': None,
+            'files': 2,
+            'bytes': 2_000_000,
+        }], self.history.runs())
+
+    def test_recorded_run(self):
+        with self.history.recorded_run('cat', 'fileset_a', 'destA') as run:
+            run.record_errors(2)
+
+        with self.assertRaises(ValueError), self.history.recorded_run('cat'):
+            raise ValueError('any error')
+
+        self.assertEqual([('cat', None, None, 1, "ValueError('any error')"), ('cat', 'fileset_a', 'destA', 2, None)],
+                         [(run['catalogue'], run['fileset'], run['destination'], run['errors'], run['error'])
+                          for run in self.history.runs()])
+
+    def test_failed_run(self):
+        with patch('gobdistribute.history.time.time', return_value=1000):
+            run = self.history.start_run('cat')
+            run.finish("GOBException('Source file a.csv not found')")
+
+        # Failed runs are returned with their error
+        self.assertEqual([(1, "GOBException('Source file a.csv not found')")],
+                         [(run['errors'], run['error']) for run in self.history.runs()])
+        self.assertIn("GOBException('Source file a.csv not found')", report(path=self.path))
+
+    def test_database_errors(self):
+        with patch('gobdistribute.history.logger') as mock_logger:
+            # The distribution continues without saving its statistics
+            history = RunHistory(os.path.join(self.directory.name, 'missing', 'history.sqlite'))
+            mock_logger.warning.assert_called_once()
+            run = history.start_run('cat')
+            run.finish()
+            self.assertEqual(1, len(history.runs()))
+            history.close()
+
+            self.history.connection.execute("DROP TABLE filesets")
+            run.history = self.history
+            run.record_fileset('fileset_a', 2, 2_000_000, 1.0)
+            self.assertEqual(2, mock_logger.warning.call_count)
+
+            # Not a database
+            path = os.path.join(self.directory.name, 'other.sqlite')
+            with open(path, 'w') as f:
+                f.write('x' * 1000)
+            RunHistory(path).close()
+            self.assertEqual(3, mock_logger.warning.call_count)
+
+    def test_upgrade(self):
+        path = os.path.join(self.directory.name, 'upgrade.sqlite')
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE runs (id INTEGER PRIMARY KEY AUTOINCREMENT, catalogue TEXT NOT NULL, "
+                           "fileset TEXT, started_at REAL NOT NULL, duration REAL, errors INTEGER)")
+        connection.execute("CREATE TABLE filesets (run_id INTEGER NOT NULL REFERENCES runs (id), "
+                           "fileset TEXT NOT NULL, files INTEGER NOT NULL, bytes INTEGER NOT NULL, "
+                           "duration REAL NOT NULL)")
+        connection.commit()
+
+        connection.close()
+
+        history = RunHistory(path)
+        run = history.start_run('cat', destination='destA')
+        run.record_fileset('fileset_a', 1, 100, 1.0)
+        run.finish('error')
+        self.assertEqual('error', history.runs()[0]['error'])
+        self.assertEqual('destA', history.runs()[0]['destination'])
+        self.assertEqual(100, history.runs()[0]['bytes'])
+        history.close()
+
+    def test_retry(self):
+        run = self.history.start_run('cat')
+        run.record_fileset('fileset_a', 2, 200, 1.0)
+        run.record_fileset('fileset_a', 2, 200, 1.0, retry=True)
+        run.finish()
+
+        # The retry is not added to the totals of the run
+        self.assertEqual((2, 200), (self.history.runs()[0]['files'], self.history.runs()[0]['bytes']))
+
+    def test_runs(self):
+        self._run('cat', 1000, 10, 5)
+        self._run('othercat', 2000, 10, 5)
+        self._run('cat', 3000, 10, 5)
+
+        self.assertEqual([3000, 2000, 1000], [run['started_at'] for run in self.history.runs()])
+        self.assertEqual([3000, 1000], [run['started_at'] for run in self.history.runs('cat')])
+        self.assertEqual([3000], [run['started_at'] for run in self.history.runs(limit=1)])
+
+    def test_destination_durations(self):
+        run1 = self._run('cat', 1000, 10, 5)
+        run2 = self._run('cat', 2000, 10, 6)
+        run3 = self._run('cat', 3000, 10, 7, error='error')
+
+        self.assertEqual({('fileset_a', 'destA'): {run1.id: 5, run2.id: 6}},
+                         self.history.destination_durations([run1.id, run2.id, run3.id]))
+
+    def test_report(self):
+        self.assertEqual("No runs found", report(path=self.path))
+
+        self._run('cat', 1000, 10, 5)
+        self._run('cat', 2000, 12, 5)
+        self._run('othercat', 2500, 100, 50)
+        self._run('cat', 3000, 11, 5)
+
+        result = report('cat', path=self.path)
+        self.assertNotIn('othercat', result)
+        self.assertEqual(6, len(result.split("\n")))
+        self.assertIn("cat", result.split("\n")[1])
+        self.assertIn("0.18", result.split("\n")[1])
+        self.assertTrue(result.endswith("No regressions"))
+
+        # Slower run and slower destination
+        self._run('cat', 4000, 30, 9)
+        result = report(path=self.path)
+        self.assertIn("Regression: Run of cat took 30.0 seconds (more than 1.5x the median)", result)
+        self.assertIn("Regression: Distribution of fileset_a to destA took 9.0 seconds (more than 1.5x the median)",
+                      result)
+
+        # Runs are only compared to runs of the same destination
+        self._run('cat', 5000, 10, 5, destination='destA')
+        self._run('cat', 6000, 30, 9, destination='destB')
+        self.assertTrue(report(path=self.path).endswith("No regressions"))
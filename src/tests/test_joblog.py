@@ -0,0 +1,45 @@
+import contextvars
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from gobdistribute.joblog import job_log, logger
+
+
+@patch('gobdistribute.joblog._logger')
+class TestJobLog(TestCase):
+
+    def test_job_log(self, mock_logger):
+        logger.warning('outside any job')
+
+        with job_log() as summary:
+            logger.warning('any warning', extra='any extra')
+            logger.error('any error')
+            logger.info('any info')
+
+            with job_log() as inner_summary:
+                logger.error('inner error')
+
+            logger.error('another error')
+
+        logger.error('after the job')
+
+        self.assertEqual({'warnings': ['any warning'], 'errors': ['any error', 'another error']}, summary)
+        self.assertEqual({'warnings': [], 'errors': ['inner error']}, inner_summary)
+
+        # All messages are passed on to the gobcore logger
+        mock_logger.warning.assert_any_call('any warning', extra='any extra')
+        mock_logger.info.assert_called_with('any info')
+        self.assertEqual(4, mock_logger.error.call_count)
+
+    def test_job_log_threads(self, mock_logger):
+        with job_log() as summary:
+            # Threads that run in a copy of the context log to the job, other threads do not
+            in_job = threading.Thread(target=contextvars.copy_context().run, args=(logger.error, 'in job'))
+            other = threading.Thread(target=logger.error, args=('other job',))
+            for thread in (in_job, other):
+                thread.start()
+                thread.join()
+
+        self.assertEqual(['in job'], summary['errors'])
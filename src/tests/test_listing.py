@@ -0,0 +1,77 @@
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from gobdistribute.listing import ListingCache
+
+
+class TestListingCache(TestCase):
+
+    def setUp(self):
+        self.datastore = MagicMock()
+        self.datastore.list_files.return_value = ['dir/a.csv', 'dir/b.csv']
+
+    @patch('gobdistribute.listing.time.monotonic')
+    def test_find_files_cached(self, mock_monotonic):
+        cache = ListingCache(ttl=10)
+        mock_monotonic.return_value = 100
+
+        self.assertEqual(['dir/a.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/a.csv'))
+        self.datastore.list_files.assert_called_once_with('dir')
+
+        # Cached listing within TTL
+        mock_monotonic.return_value = 109
+        self.assertEqual(['dir/b.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/b.csv'))
+        self.datastore.list_files.assert_called_once()
+
+        # Listings are cached per destination and directory
+        cache.find_files(self.datastore, 'destB', 'dir', 'dir/a.csv')
+        cache.find_files(self.datastore, 'destA', 'otherdir', 'otherdir/a.csv')
+        self.assertEqual(3, self.datastore.list_files.call_count)
+
+        # Refresh after TTL
+        mock_monotonic.return_value = 110
+        cache.find_files(self.datastore, 'destA', 'dir', 'dir/a.csv')
+        self.assertEqual(4, self.datastore.list_files.call_count)
+
+    def test_add_remove_file(self):
+        cache = ListingCache(ttl=10)
+
+        # Changes to directories that have not been listed are ignored
+        cache.add_file('destA', 'dir', 'dir/c.csv')
+        cache.remove_file('destA', 'dir', 'dir/a.csv')
+        self.assertEqual(['dir/a.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/a.csv'))
+        self.assertEqual([], cache.find_files(self.datastore, 'destA', 'dir', 'dir/c.csv'))
+
+        cache.add_file('destA', 'dir', 'dir/c.csv')
+        cache.remove_file('destA', 'dir', 'dir/a.csv')
+        cache.remove_file('destA', 'dir', 'dir/d.csv')
+        self.assertEqual([], cache.find_files(self.datastore, 'destA', 'dir', 'dir/a.csv'))
+        self.assertEqual(['dir/c.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/c.csv'))
+        self.datastore.list_files.assert_called_once()
+
+    def test_invalidate(self):
+        cache = ListingCache(ttl=10)
+
+        cache.find_files(self.datastore, 'destA', 'dir', 'dir/a.csv')
+        cache.invalidate('destA', 'dir')
+        cache.invalidate('destA', 'otherdir')
+        cache.find_files(self.datastore, 'destA', 'dir', 'dir/a.csv')
+        self.assertEqual(2, self.datastore.list_files.call_count)
+
+    def test_find_files(self):
+        self.datastore.list_files.return_value = ['dir/a1.csv', 'dir/a2.csv', 'dir/b.csv']
+        cache = ListingCache(ttl=10, normalize=lambda filename: filename.replace('1', '#').replace('2', '#'))
+
+        self.assertEqual(['dir/a1.csv', 'dir/a2.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/a2.csv'))
+        self.assertEqual(['dir/b.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/b.csv'))
+        self.assertEqual([], cache.find_files(self.datastore, 'destA', 'dir', 'dir/c.csv'))
+
+        # The index is kept up to date with the files that are added and removed
+        cache.remove_file('destA', 'dir', 'dir/a1.csv')
+        cache.add_file('destA', 'dir', 'dir/c.csv')
+        self.assertEqual(['dir/a2.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/a1.csv'))
+        self.assertEqual(['dir/c.csv'], cache.find_files(self.datastore, 'destA', 'dir', 'dir/c.csv'))
+
+        cache.remove_file('destA', 'dir', 'dir/a2.csv')
+        self.assertEqual([], cache.find_files(self.datastore, 'destA', 'dir', 'dir/a1.csv'))
+        self.datastore.list_files.assert_called_once()
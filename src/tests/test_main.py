@@ -1,6 +1,14 @@
+import os
+import subprocess
+import sys
+
 from unittest import mock, TestCase
 
-from gobdistribute import __main__
+from gobdistribute import __main__, joblog
+from gobdistribute.sharding import LocalBroker
+
+# Maximum import time, in microseconds, of the service. Generous, to allow for slow test environments
+STARTUP_IMPORT_TIME_BOUND = 3_000_000
 
 
 class TestMain(TestCase):
@@ -9,10 +17,23 @@ class TestMain(TestCase):
     def test_messagedriven_service(self, mocked_messagedriven_service):
         from gobdistribute import __main__ as module
 
-        with mock.patch.object(module, '__name__', '__main__'):
+        with mock.patch.object(module, '__name__', '__main__'), mock.patch.object(module.sys, 'argv', ['gobdistribute']):
             __main__.init()
             mocked_messagedriven_service.assert_called_with(__main__.SERVICEDEFINITION, "Distribute")
 
+    @mock.patch("builtins.print")
+    @mock.patch("gobdistribute.__main__.report")
+    @mock.patch("gobdistribute.__main__.messagedriven_service")
+    def test_main_history(self, mocked_messagedriven_service, mock_report, mock_print):
+        __main__.main(["history"])
+        mock_report.assert_called_with(None, 10)
+        mock_print.assert_called_with(mock_report.return_value)
+
+        __main__.main(["history", "catalogue", "--runs", "5"])
+        mock_report.assert_called_with("catalogue", 5)
+
+        mocked_messagedriven_service.assert_not_called()
+
     @mock.patch("gobdistribute.__main__.logger")
     @mock.patch('gobdistribute.__main__.distribute')
     def test_handle_distribute_msg(self, mock_distribute, mock_logger):
@@ -25,12 +46,81 @@ class TestMain(TestCase):
             "any other arg": "any other arg",
         }
 
-        __main__.handle_distribute_msg(msg)
+        with mock.patch('gobdistribute.__main__.profiled') as mock_profiled:
+            __main__.handle_distribute_msg(msg)
+            mock_profiled.assert_called_with("distribute_catalogue_fileset_", enabled=False)
+
+            msg['header']['profile'] = True
+            msg['header']['process_id'] = 'process'
+            __main__.handle_distribute_msg(msg)
+            mock_profiled.assert_called_with("distribute_catalogue_fileset_process", enabled=True)
 
         mock_distribute.assert_called_with(
             catalogue="catalogue",
             fileset="fileset")
 
+    @mock.patch('gobdistribute.__main__.RunHistory')
+    @mock.patch('gobdistribute.joblog._logger', mock.MagicMock())
+    @mock.patch('gobdistribute.__main__.distribute')
+    @mock.patch('gobdistribute.__main__.get_filesets')
+    def test_handle_distribute_msg_sharded(self, mock_get_filesets, mock_distribute, mock_run_history):
+        def get_filesets(catalogue):
+            joblog.logger.warning('config warning')
+            return {'fileset_a': {}, 'fileset_b': {}}
+
+        mock_get_filesets.side_effect = get_filesets
+        mock_distribute.side_effect = lambda catalogue, fileset, destination: joblog.logger.error(f"{fileset} error")
+
+        msg = {
+            "header": {
+                "catalogue": "catalogue",
+                "shard_by": "fileset",
+            }
+        }
+
+        # A single replica processes all sub-jobs itself, each sub-job is profiled on its own
+        with mock.patch('gobdistribute.__main__.broker', LocalBroker()), \
+                mock.patch('gobdistribute.__main__.profiled') as mock_profiled:
+            result = __main__.handle_distribute_msg(msg)
+
+        mock_profiled.assert_has_calls([
+            mock.call("distribute_catalogue_fileset_a_", enabled=False),
+            mock.call("distribute_catalogue_fileset_b_", enabled=False),
+        ], any_order=True)
+        self.assertEqual(2, mock_profiled.call_count)
+
+        mock_get_filesets.assert_called_with('catalogue')
+        mock_distribute.assert_has_calls([
+            mock.call(catalogue='catalogue', fileset='fileset_a', destination=None),
+            mock.call(catalogue='catalogue', fileset='fileset_b', destination=None),
+        ])
+        self.assertEqual({
+            "header": msg["header"],
+            "summary": {"warnings": ['config warning'], "errors": ['fileset_a error', 'fileset_b error']},
+            "contents": None
+        }, result)
+
+        # The sharded distribution is recorded as a run of the catalogue
+        history = mock_run_history.return_value
+        history.recorded_run.assert_called_with('catalogue')
+        history.recorded_run.return_value.__enter__.return_value.record_errors.assert_called_with(2)
+        history.close.assert_called_once()
+
+    @mock.patch('gobdistribute.__main__.profiled')
+    @mock.patch('gobdistribute.__main__.process_shard')
+    def test_handle_shard_msg(self, mock_process_shard, mock_profiled):
+        msg = {'header': {'catalogue': 'catalogue', 'fileset': 'fileset', 'destination': 'destination',
+                          'process_id': 'process', 'profile': True}}
+        __main__.handle_shard_msg(msg)
+        mock_process_shard.assert_called_with(msg, __main__.broker, __main__.distribute)
+        mock_profiled.assert_called_with("distribute_catalogue_fileset_destination_process", enabled=True)
+
+    @mock.patch('gobdistribute.__main__.declare_shard_queue')
+    def test_servicedefinition_shard_queue(self, mock_declare_shard_queue):
+        queue = __main__.SERVICEDEFINITION['distribute_shard']['queue']
+        self.assertEqual(mock_declare_shard_queue.return_value, queue())
+        mock_declare_shard_queue.assert_called_with(__main__.broker)
+
     @mock.patch('gobdistribute.__main__.logger', mock.MagicMock())
     @mock.patch("gobdistribute.__main__.get_notification")
     @mock.patch("gobdistribute.__main__.start_workflow")
@@ -56,3 +146,21 @@ class TestMain(TestCase):
                 'process_id': 'PROCESS_ID'
             }
         )
+
+    def test_startup_imports(self):
+        # The datastore backends are loaded on first use, not on startup of the service
+        backends = ['paramiko', 'swiftclient', 'gobcore.datastore.factory', 'gobcore.datastore.sftp']
+        code = "import sys, gobdistribute.__main__; " \
+               f"print([module for module in {backends} if module in sys.modules])"
+
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(__file__)), check=True)
+
+        self.assertEqual("[]", result.stdout.strip())
+
+        # The import time of each module is traced on stderr as "import time: self [us] | cumulative | module"
+        cumulative = {line.split("|")[2].strip(): int(line.split("|")[1])
+                      for line in result.stderr.splitlines() if line.startswith("import time:") and "[us]" not in line}
+        self.assertIn("gobdistribute.distribute", cumulative)
+        self.assertLess(cumulative["gobdistribute.__main__"], STARTUP_IMPORT_TIME_BOUND,
+                        f"Import of gobdistribute.__main__ took {cumulative['gobdistribute.__main__'] / 1e6:.2f}s")
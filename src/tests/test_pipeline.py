@@ -0,0 +1,95 @@
+import queue
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from gobdistribute.pipeline import Pipeline
+
+
+class TestPipeline(TestCase):
+
+    def test_pipeline(self):
+        with Pipeline(iter(range(5)), 2) as pipeline:
+            self.assertEqual([0, 1, 2, 3, 4], list(pipeline))
+
+    def test_backpressure(self):
+        produced = []
+        held = threading.Event()
+
+        def items():
+            for item in range(10):
+                produced.append(item)
+                if item == 3:
+                    held.set()
+                yield item
+
+        with Pipeline(items(), 2) as pipeline:
+            iterator = iter(pipeline)
+            self.assertEqual(0, next(iterator))
+
+            # The producer is held when 2 items wait to be consumed, and the next item has been produced
+            self.assertTrue(held.wait(5))
+            self.assertTrue(pipeline._queue.full())
+            self.assertEqual([0, 1, 2, 3], produced)
+
+            self.assertEqual(list(range(1, 10)), list(iterator))
+
+    def test_failure(self):
+        def items():
+            yield 1
+            raise ValueError("any error")
+
+        with Pipeline(items(), 2) as pipeline:
+            iterator = iter(pipeline)
+            self.assertEqual(1, next(iterator))
+
+            with self.assertRaisesRegex(ValueError, "any error"):
+                next(iterator)
+
+    def test_put(self):
+        with Pipeline(iter([]), 1) as pipeline:
+            # The item is put as soon as there is room
+            with patch.object(pipeline._queue, 'put', side_effect=[queue.Full, None]) as mock_put:
+                self.assertTrue(pipeline._put('item'))
+            self.assertEqual(2, mock_put.call_count)
+
+            # But not after the pipeline has been closed
+            pipeline._closed.set()
+            self.assertFalse(pipeline._put('item'))
+
+    def test_close(self):
+        discard = MagicMock()
+
+        with Pipeline(iter(range(10)), 2, discard) as pipeline:
+            self.assertEqual(0, next(iter(pipeline)))
+
+        # The producer has stopped, the items that have been produced but not consumed are discarded
+        discarded = [args[0] for args, _ in discard.call_args_list]
+        self.assertEqual(list(range(1, len(discarded) + 1)), discarded)
+        self.assertLessEqual(len(discarded), 3)
+
+    def test_close_without_discard(self):
+        failed = threading.Event()
+
+        def items():
+            yield 1
+            failed.set()
+            raise ValueError
+
+        pipeline = Pipeline(items(), 2)
+        failed.wait(1)
+        pipeline.close()
+
+        # The producer has stopped, the produced item and the failure have been drained
+        self.assertFalse(pipeline._thread.is_alive())
+        self.assertTrue(pipeline._queue.empty())
+
+    @patch('gobdistribute.pipeline.profile_thread')
+    def test_profile_thread_failure(self, mock_profile_thread):
+        mock_profile_thread.return_value.__enter__.side_effect = ValueError("Another profiling tool is already active")
+
+        # The consumer gets the failure of the profiler instead of waiting forever
+        with Pipeline(iter(range(10)), 2) as pipeline:
+            with self.assertRaisesRegex(ValueError, "Another profiling tool"):
+                list(pipeline)
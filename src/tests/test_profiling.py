@@ -0,0 +1,110 @@
+import contextvars
+import os
+import tempfile
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from gobdistribute.profiling import profiled, profile_thread
+
+
+def hotspot():
+    return sum(i * i for i in range(1000))
+
+
+def thread_hotspot():
+    return sum(i * i for i in range(1000))
+
+
+def run_in_thread():
+    def target():
+        with profile_thread():
+            thread_hotspot()
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target,))
+    thread.start()
+    thread.join()
+
+
+@patch('gobdistribute.profiling.logger', MagicMock())
+class TestProfiling(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_not_enabled(self):
+        with patch('gobdistribute.profiling.PROFILE_DIR', self.directory.name):
+            with profiled("name", enabled=False):
+                hotspot()
+
+        self.assertEqual([], os.listdir(self.directory.name))
+
+    @patch('gobdistribute.profiling.SamplingProfiler', None)
+    def test_cprofile(self):
+        with patch('gobdistribute.profiling.PROFILE_DIR', self.directory.name):
+            with profiled("distribute cat/fileset", enabled=True):
+                hotspot()
+                run_in_thread()
+
+        self.assertEqual(['distribute_cat_fileset.prof', 'distribute_cat_fileset.txt'],
+                         sorted(os.listdir(self.directory.name)))
+
+        # The background thread is merged into the profile
+        with open(os.path.join(self.directory.name, 'distribute_cat_fileset.txt')) as f:
+            summary = f.read()
+            self.assertIn('(hotspot)', summary)
+            self.assertIn('(thread_hotspot)', summary)
+
+    @patch('gobdistribute.profiling.SamplingProfiler', None)
+    @patch('gobdistribute.profiling._save_cprofile', return_value='summary')
+    def test_concurrent_profiles(self, mock_save):
+        # Each profiled block only gets the background threads that run within its own context
+        entered = threading.Barrier(2, timeout=5)
+
+        def profile(name, target):
+            with profiled(name, enabled=True):
+                entered.wait()
+                target()
+
+        with patch('gobdistribute.profiling.PROFILE_DIR', self.directory.name):
+            other = threading.Thread(target=profile, args=('other', run_in_thread))
+            other.start()
+            profile('block', hotspot)
+            other.join()
+
+        thread_profiles = {os.path.basename(args[1]): args[2] for args, _ in mock_save.call_args_list}
+        self.assertEqual(1, len(thread_profiles['other']))
+        self.assertEqual([], thread_profiles['block'])
+
+    def test_profile_thread_not_profiling(self):
+        with patch('gobdistribute.profiling.cProfile.Profile') as mock_profile:
+            run_in_thread()
+        mock_profile.assert_not_called()
+
+    @patch('gobdistribute.profiling.SamplingProfiler')
+    def test_sampling_profiler(self, mock_profiler):
+        mock_profiler.return_value.output_html.return_value = "html"
+        mock_profiler.return_value.output_text.return_value = "text"
+
+        with patch('gobdistribute.profiling.PROFILE_DIR', self.directory.name):
+            with self.assertRaises(ValueError):
+                with profiled("name", enabled=True):
+                    run_in_thread()
+                    raise ValueError
+
+        mock_profiler.return_value.start.assert_called_once()
+        mock_profiler.return_value.stop.assert_called_once()
+
+        with open(os.path.join(self.directory.name, 'name.html')) as f:
+            self.assertEqual('html', f.read())
+
+        # The background thread is profiled separately by cProfile
+        self.assertTrue(os.path.exists(os.path.join(self.directory.name, 'name.threads.prof')))
+        with open(os.path.join(self.directory.name, 'name.txt')) as f:
+            summary = f.read()
+            self.assertTrue(summary.startswith('text\nBackground threads\n'))
+            self.assertIn('(thread_hotspot)', summary)
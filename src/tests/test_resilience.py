@@ -0,0 +1,114 @@
+from unittest import TestCase
+from unittest.mock import call, patch, MagicMock
+
+from gobdistribute.resilience import is_not_found, is_transient, with_retries, CircuitBreaker, get_circuit_breaker
+
+
+class SSHException(Exception):
+    pass
+
+
+class ClientException(Exception):
+
+    def __init__(self, http_status):
+        super().__init__()
+        self.http_status = http_status
+
+
+@patch('gobdistribute.resilience.logger', MagicMock())
+class TestResilience(TestCase):
+
+    def test_is_transient(self):
+        testcases = [
+            (ConnectionResetError(), True),
+            (TimeoutError(), True),
+            (OSError(), True),
+            (SSHException(), True),
+            (type('ChannelException', (SSHException,), {})(), True),
+            (type('BadHostKeyException', (SSHException,), {})(), False),
+            (type('BadAuthenticationType', (type('AuthenticationException', (SSHException,), {}),), {})(), False),
+            (ClientException(503), True),
+            (ClientException(404), False),
+            (FileNotFoundError(), False),
+            (PermissionError(), False),
+            (ValueError(), False),
+        ]
+
+        for error, transient in testcases:
+            self.assertEqual(transient, is_transient(error), error)
+
+    def test_is_not_found(self):
+        self.assertTrue(is_not_found(FileNotFoundError()))
+        self.assertTrue(is_not_found(ClientException(404)))
+        self.assertFalse(is_not_found(ClientException(503)))
+        self.assertFalse(is_not_found(OSError()))
+
+    @patch('gobdistribute.resilience.RETRY_BACKOFF', 1)
+    @patch('gobdistribute.resilience.RETRY_MAX_BACKOFF', 3)
+    @patch('gobdistribute.resilience.random.uniform')
+    @patch('gobdistribute.resilience.time.sleep')
+    def test_with_retries(self, mock_sleep, mock_uniform):
+        func = MagicMock(side_effect=[ConnectionResetError, ConnectionResetError, ConnectionResetError, 'result'])
+        mock_uniform.return_value = 0.5
+
+        self.assertEqual('result', with_retries(func, 'a', b='b', attempts=4))
+        func.assert_called_with('a', b='b')
+        self.assertEqual(4, func.call_count)
+
+        # Exponential backoff, limited to the maximum backoff
+        mock_uniform.assert_has_calls([call(0, 1), call(0, 2), call(0, 3)])
+        mock_sleep.assert_has_calls([call(0.5)] * 3)
+
+    @patch('gobdistribute.resilience.time.sleep')
+    def test_with_retries_exhausted(self, mock_sleep):
+        func = MagicMock(side_effect=ConnectionResetError)
+
+        with self.assertRaises(ConnectionResetError):
+            with_retries(func, attempts=3)
+        self.assertEqual(3, func.call_count)
+
+    @patch('gobdistribute.resilience.time.sleep')
+    def test_with_retries_permanent_error(self, mock_sleep):
+        func = MagicMock(side_effect=FileNotFoundError)
+
+        with self.assertRaises(FileNotFoundError):
+            with_retries(func)
+        func.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch('gobdistribute.resilience.time.monotonic')
+    def test_circuit_breaker(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        circuit_breaker = CircuitBreaker('destA', threshold=2, reset_timeout=60)
+
+        self.assertTrue(circuit_breaker.allow())
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+
+        # Successes reset the failure count
+        circuit_breaker.record_success()
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow())
+
+        # Allow a new attempt after the reset timeout
+        mock_monotonic.return_value = 160
+        self.assertTrue(circuit_breaker.allow())
+
+        # Failure of the new attempt puts the destination on hold again
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow())
+
+        mock_monotonic.return_value = 220
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.allow())
+        self.assertEqual(0, circuit_breaker.failures)
+
+    def test_get_circuit_breaker(self):
+        circuit_breaker = get_circuit_breaker('destA')
+
+        self.assertEqual('destA', circuit_breaker.name)
+        self.assertIs(circuit_breaker, get_circuit_breaker('destA'))
+        self.assertIsNot(circuit_breaker, get_circuit_breaker('destB'))
@@ -0,0 +1,257 @@
+import json
+import threading
+
+from unittest import TestCase
+from unittest.mock import call, patch, MagicMock
+
+from gobdistribute.sharding import MessageBroker, LocalBroker, declare_shard_queue, split, distribute_sharded, \
+    process_shard, SHARD_QUEUE
+from gobdistribute.joblog import logger
+
+FILESETS = {
+    'fileset_a': {'destinations': [{'name': 'destA'}, {'name': 'destB'}]},
+    'fileset_b': {'destinations': [{'name': 'destA'}]},
+}
+
+
+class TestBrokers(TestCase):
+
+    def test_local_broker(self):
+        broker = LocalBroker()
+
+        broker.declare('queue')
+        self.assertIsNone(broker.get('queue'))
+
+        broker.publish('queue', {'a': 1})
+        broker.publish('queue', {'b': 2})
+        self.assertEqual({'a': 1}, broker.get('queue'))
+        self.assertEqual({'b': 2}, broker.get('queue'))
+        self.assertIsNone(broker.get('queue'))
+
+        broker.publish('queue', {'a': 1})
+        broker.delete('queue')
+        broker.delete('queue')
+        self.assertIsNone(broker.get('queue'))
+
+    def test_local_broker_receive(self):
+        broker = LocalBroker()
+
+        with broker.receive('queue') as msg:
+            self.assertIsNone(msg)
+
+        broker.publish('queue', {'a': 1})
+        broker.publish('queue', {'b': 2})
+
+        # A message that fails to be processed is returned to the queue
+        with self.assertRaises(ValueError), broker.receive('queue') as msg:
+            self.assertEqual({'a': 1}, msg)
+            raise ValueError()
+
+        with broker.receive('queue') as msg:
+            self.assertEqual({'a': 1}, msg)
+        self.assertEqual({'b': 2}, broker.get('queue'))
+
+    def test_message_broker(self):
+        pika = MagicMock()
+        connection_params = MagicMock()
+        channel = pika.BlockingConnection.return_value.channel.return_value
+        channel.is_closed = False
+        broker = MessageBroker()
+
+        with patch.dict('sys.modules', {'pika': pika}), \
+                patch('gobcore.message_broker.config.CONNECTION_PARAMS', connection_params, create=True), \
+                patch('gobdistribute.sharding.copy.copy', lambda params: params):
+            broker.declare('queue')
+            channel.queue_declare.assert_called_with(queue='queue', durable=True)
+            pika.BlockingConnection.assert_called_with(connection_params)
+            self.assertEqual(0, connection_params.heartbeat)
+
+            broker.delete('queue')
+            channel.queue_delete.assert_called_with(queue='queue')
+
+            broker.publish('queue', {'a': 1})
+            channel.basic_publish.assert_called_with(exchange='', routing_key='queue', body='{"a": 1}',
+                                                     properties=pika.BasicProperties.return_value)
+            pika.BasicProperties.assert_called_with(delivery_mode=2)
+
+            channel.basic_get.return_value = ('method', 'properties', '{"a": 1}')
+            self.assertEqual({'a': 1}, broker.get('queue'))
+            channel.basic_get.assert_called_with(queue='queue', auto_ack=True)
+
+            channel.basic_get.return_value = (None, None, None)
+            self.assertIsNone(broker.get('queue'))
+
+            # The connection is reused as long as it is open
+            pika.BlockingConnection.assert_called_once()
+            channel.is_closed = True
+            broker.get('queue')
+            self.assertEqual(2, pika.BlockingConnection.call_count)
+
+    def test_message_broker_receive(self):
+        broker = MessageBroker()
+        channel = MagicMock()
+
+        with patch.object(broker, '_channel', lambda: channel):
+            channel.basic_get.return_value = (None, None, None)
+            with broker.receive('queue') as msg:
+                self.assertIsNone(msg)
+            channel.basic_get.assert_called_with(queue='queue', auto_ack=False)
+
+            method = MagicMock()
+            channel.basic_get.return_value = (method, 'properties', '{"a": 1}')
+            with broker.receive('queue') as msg:
+                self.assertEqual({'a': 1}, msg)
+                channel.basic_ack.assert_not_called()
+            channel.basic_ack.assert_called_with(delivery_tag=method.delivery_tag)
+
+            with self.assertRaises(ValueError), broker.receive('queue') as msg:
+                raise ValueError()
+            channel.basic_nack.assert_called_with(delivery_tag=method.delivery_tag, requeue=True)
+            channel.basic_ack.assert_called_once()
+
+    def test_declare_shard_queue(self):
+        broker = MagicMock()
+        self.assertEqual(SHARD_QUEUE, declare_shard_queue(broker))
+        broker.declare.assert_called_with(SHARD_QUEUE)
+
+        with patch('gobdistribute.sharding.MessageBroker') as mock_broker:
+            declare_shard_queue()
+            mock_broker.return_value.declare.assert_called_with(SHARD_QUEUE)
+
+
+@patch('gobdistribute.joblog._logger', MagicMock())
+class TestSharding(TestCase):
+
+    def test_split(self):
+        self.assertEqual([('fileset_a', None), ('fileset_b', None)], split(FILESETS, 'fileset'))
+        self.assertEqual([('fileset_a', 'destA'), ('fileset_a', 'destB'), ('fileset_b', 'destA')],
+                         split(FILESETS, 'destination'))
+
+    def test_distribute_sharded(self):
+        broker = LocalBroker()
+        distribute = MagicMock()
+
+        def mock_distribute(catalogue, fileset, destination):
+            distribute(catalogue, fileset, destination)
+            if destination == 'destB':
+                raise ConnectionError("destB down")
+
+        summary = distribute_sharded({'catalogue': 'cat', 'process_id': 'pid'}, FILESETS, 'destination', broker,
+                                     lambda msg: process_shard(msg, broker, mock_distribute))
+
+        distribute.assert_has_calls([
+            call('cat', 'fileset_a', 'destA'),
+            call('cat', 'fileset_a', 'destB'),
+            call('cat', 'fileset_b', 'destA'),
+        ])
+        self.assertEqual({'warnings': [], 'errors': ['Distribution of fileset_a failed: destB down']}, summary)
+
+        # All queues have been processed, the reply queue has been deleted
+        self.assertEqual([SHARD_QUEUE], list(broker.queues.keys()))
+        self.assertIsNone(broker.get(SHARD_QUEUE))
+
+    def test_distribute_sharded_messages(self):
+        broker = MagicMock()
+        broker.receive.return_value.__enter__.return_value = None
+        broker.get.side_effect = [
+            None,
+            {'header': {'index': 1}, 'summary': {'warnings': ['warning b'], 'errors': []}},
+            {'header': {'index': 0}, 'summary': {'warnings': ['warning a'], 'errors': ['error a']}},
+        ]
+
+        with patch('gobdistribute.sharding.time.sleep') as mock_sleep:
+            summary = distribute_sharded({'catalogue': 'cat'}, FILESETS, 'fileset', broker, MagicMock())
+
+        mock_sleep.assert_called_once()
+        self.assertEqual({'warnings': ['warning a', 'warning b'], 'errors': ['error a']}, summary)
+
+        reply_to = broker.declare.call_args[0][0]
+        self.assertTrue(reply_to.startswith(f'{SHARD_QUEUE}.'))
+        job_id = reply_to[len(SHARD_QUEUE) + 1:]
+        broker.publish.assert_has_calls([
+            call(SHARD_QUEUE, {'header': {'catalogue': 'cat', 'fileset': 'fileset_a', 'destination': None, 'shard': {
+                'job_id': job_id, 'index': 0, 'count': 2, 'reply_to': reply_to}}}),
+            call(SHARD_QUEUE, {'header': {'catalogue': 'cat', 'fileset': 'fileset_b', 'destination': None, 'shard': {
+                'job_id': job_id, 'index': 1, 'count': 2, 'reply_to': reply_to}}}),
+        ])
+        broker.delete.assert_called_with(reply_to)
+
+    def test_distribute_sharded_idle_timeout(self):
+        broker = MagicMock()
+        broker.get.side_effect = [
+            None,
+            {'header': {'index': 0}, 'summary': {'warnings': [], 'errors': []}},
+            None,
+        ]
+        broker.receive.return_value.__enter__.return_value = None
+
+        # Each result resets the timeout
+        with patch('gobdistribute.sharding.SHARD_TIMEOUT', 10), \
+                patch('gobdistribute.sharding.time.sleep'), \
+                patch('gobdistribute.sharding.time.monotonic', side_effect=[0, 5, 8, 9, 15, 20]):
+            summary = distribute_sharded({'catalogue': 'cat'}, FILESETS, 'fileset', broker, MagicMock())
+
+        self.assertEqual(3, broker.get.call_count)
+        self.assertEqual({'warnings': [], 'errors': [
+            'No result received for the distribution of fileset_b',
+        ]}, summary)
+
+    @patch('gobdistribute.sharding.SHARD_TIMEOUT', 0)
+    def test_distribute_sharded_timeout(self):
+        broker = MagicMock()
+
+        summary = distribute_sharded({'catalogue': 'cat'}, FILESETS, 'destination', broker, MagicMock())
+
+        self.assertEqual({'warnings': [], 'errors': [
+            'No result received for the distribution of fileset_a to destA',
+            'No result received for the distribution of fileset_a to destB',
+            'No result received for the distribution of fileset_b to destA',
+        ]}, summary)
+
+    def test_process_shard(self):
+        broker = LocalBroker()
+        msg = {'header': {'catalogue': 'cat', 'fileset': 'fileset_a', 'destination': None,
+                          'shard': {'job_id': 'job', 'index': 3, 'count': 5, 'reply_to': 'reply'}}}
+        logger.warning('earlier warning')
+
+        def distribute(catalogue, fileset, destination):
+            logger.warning('any warning')
+
+            # Messages of other jobs, eg in another thread, are not part of the result
+            other_job = threading.Thread(target=logger.error, args=('other error',))
+            other_job.start()
+            other_job.join()
+
+        process_shard(msg, broker, distribute)
+
+        self.assertEqual({
+            'header': {'job_id': 'job', 'index': 3},
+            'summary': {'warnings': ['any warning'], 'errors': []}
+        }, broker.get('reply'))
+        self.assertEqual(json.loads(json.dumps(msg)), msg)
+
+    def test_gather_lock(self):
+        broker = LocalBroker()
+        process = MagicMock()
+        lock = threading.RLock()
+
+        # Pending sub-jobs are left to other replicas while another distribution is running
+        acquired, release = threading.Event(), threading.Event()
+
+        def other_distribution():
+            with lock:
+                acquired.set()
+                release.wait(5)
+
+        other = threading.Thread(target=other_distribution)
+        other.start()
+        acquired.wait(5)
+
+        with patch('gobdistribute.sharding.SHARD_TIMEOUT', 0.1), patch('gobdistribute.sharding.time.sleep'):
+            summary = distribute_sharded({'catalogue': 'cat'}, {'fileset_a': {}}, 'fileset', broker, process, lock)
+
+        release.set()
+        other.join()
+        process.assert_not_called()
+        self.assertEqual(['No result received for the distribution of fileset_a'], summary['errors'])
+        self.assertIsNotNone(broker.get(SHARD_QUEUE))
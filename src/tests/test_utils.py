@@ -1,6 +1,8 @@
+import sys
+
 from unittest import mock, TestCase
 
-from gobdistribute.utils import json_loads, get_with_retries
+from gobdistribute.utils import json_loads, get_with_retries, lazy_import
 
 
 class TestUtils(TestCase):
@@ -29,3 +31,16 @@ class TestUtils(TestCase):
         mock_session.return_value.mount.assert_called_with("http://exportapihost", mock_httpadapter.return_value)
         mock_httpadapter.assert_called_with(max_retries=mock_retry.return_value)
         mock_retry.assert_called_with(total=5, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+
+    def test_lazy_import(self):
+        self.assertIs(sys.modules['json'], lazy_import('json'))
+
+        sys.modules.pop('tests.lazy_module', None)
+        module = lazy_import('tests.lazy_module')
+        self.assertIs(sys.modules['tests.lazy_module'], module)
+        self.assertIs(module, lazy_import('tests.lazy_module'))
+
+        # The module is executed on first access
+        self.assertEqual('_LazyModule', type(module).__name__)
+        self.assertEqual('value', module.VALUE)
+        self.assertNotEqual('_LazyModule', type(module).__name__)
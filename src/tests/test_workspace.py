@@ -0,0 +1,134 @@
+import os
+import tempfile
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+
+from gobcore.exceptions import GOBException
+
+from gobdistribute.workspace import Workspace
+
+
+@patch('gobdistribute.workspace.logger', MagicMock())
+class TestWorkspace(TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(self.base_dir)
+        self.assertEqual(0, Workspace._reserved)
+
+    def test_workspace(self):
+        with Workspace('fileset', self.base_dir) as workspace:
+            self.assertTrue(os.path.isdir(workspace.path))
+            self.assertTrue(os.path.basename(workspace.path).startswith('fileset.'))
+
+            filepath = workspace.filepath('some/dir/file.csv')
+            self.assertEqual(os.path.join(workspace.path, 'some/dir/file.csv'), filepath)
+            self.assertTrue(os.path.isdir(os.path.dirname(filepath)))
+
+            with open(filepath, 'w') as f:
+                f.write('contents')
+
+            workspace.reserve(100)
+            self.assertEqual(100, workspace.reserved)
+            self.assertEqual(100, Workspace._reserved)
+
+            path = workspace.path
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(0, workspace.reserved)
+
+    def test_workspaces_are_unique(self):
+        with Workspace('fileset', self.base_dir) as workspace1, Workspace('fileset', self.base_dir) as workspace2:
+            self.assertNotEqual(workspace1.path, workspace2.path)
+
+    def test_cleanup_on_exception(self):
+        with self.assertRaises(ValueError):
+            with Workspace('fileset', self.base_dir) as workspace:
+                workspace.reserve(100)
+                raise ValueError
+
+        self.assertIsNone(workspace.path)
+
+    def test_reserve_exceeds_budget(self):
+        with Workspace('fileset', self.base_dir, budget=100) as workspace:
+            with self.assertRaisesRegex(GOBException, "exceeds workspace budget"):
+                workspace.reserve(101)
+
+    def test_release(self):
+        with Workspace('fileset', self.base_dir, budget=100, timeout=10) as workspace:
+            filepath = workspace.filepath('file.csv')
+            with open(filepath, 'w') as f:
+                f.write('contents')
+            workspace.reserve(60)
+
+            release = threading.Timer(0.1, workspace.release, args=(filepath, 60))
+            release.start()
+
+            # Held until the space of the distributed file is released
+            workspace.reserve(60)
+            release.join()
+
+            self.assertFalse(os.path.exists(filepath))
+            self.assertEqual(60, workspace.reserved)
+            self.assertEqual(60, Workspace._reserved)
+
+            # A file that does not exist is only released
+            workspace.release(filepath, 60)
+            self.assertEqual(0, Workspace._reserved)
+
+    @patch('gobdistribute.workspace.shutil.disk_usage')
+    def test_reserve_exceeds_disk_space(self, mock_disk_usage):
+        mock_disk_usage.return_value.free = 50
+
+        with Workspace('fileset', self.base_dir) as workspace:
+            with self.assertRaisesRegex(GOBException, "insufficient space"):
+                workspace.reserve(60)
+
+            workspace.reserve(50)
+            self.assertEqual(50, workspace.reserved)
+
+    @patch('gobdistribute.workspace.shutil.disk_usage')
+    def test_reserve_unwritten(self, mock_disk_usage):
+        mock_disk_usage.return_value.free = 100
+
+        with Workspace('fileset', self.base_dir, timeout=0.1) as workspace:
+            workspace.reserve(60)
+
+            # The file for the first reservation has not been written, so it is not in the free disk space
+            with self.assertRaisesRegex(GOBException, "insufficient space"):
+                workspace.reserve(60)
+
+            workspace.written(60)
+            mock_disk_usage.return_value.free = 40
+            workspace.reserve(40)
+            self.assertEqual(100, workspace.reserved)
+            self.assertEqual(40, Workspace._unwritten)
+
+        self.assertEqual(0, Workspace._unwritten)
+
+    def test_reserve_on_hold(self):
+        with Workspace('fileset_a', self.base_dir, budget=100, timeout=10) as workspace_a:
+            workspace_a.reserve(80)
+
+            with Workspace('fileset_b', self.base_dir, budget=100, timeout=10) as workspace_b:
+                release = threading.Timer(0.1, workspace_a.cleanup)
+                release.start()
+
+                # Held until workspace_a releases its space
+                workspace_b.reserve(80)
+                release.join()
+
+                self.assertEqual(80, workspace_b.reserved)
+                self.assertEqual(80, Workspace._reserved)
+
+    def test_reserve_on_hold_timeout(self):
+        with Workspace('fileset_a', self.base_dir, budget=100) as workspace_a:
+            workspace_a.reserve(80)
+
+            with Workspace('fileset_b', self.base_dir, budget=100, timeout=0.1) as workspace_b:
+                with self.assertRaisesRegex(GOBException, "insufficient space"):
+                    workspace_b.reserve(80)